@@ -0,0 +1,256 @@
+from typing import Any, Iterable
+
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+WORD_BITS = 64
+# rows are processed in chunks of this many cells when unpacking bits
+UNPACK_CHUNK_CELLS = 1 << 24
+# words gathered at once in a sparse @ bits product
+GATHER_CHUNK_WORDS = 1 << 22
+
+_WORD = np.dtype("<u8")
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+
+def _words_number(cols: int) -> int:
+    return (cols + WORD_BITS - 1) // WORD_BITS
+
+
+# boolean matrix packed into rows of 64-bit words, bit j of a row is the
+# (j % 64)-th bit of its (j // 64)-th word; mirrors the part of the
+# csr_matrix interface that the automata code uses, so it can be put
+# into AdjacencyMatrixFA.boolean_decompress or used as an MS-BFS front
+class BitMatrix:
+    # make numpy and scipy operands defer to our reflected operators
+    __array_priority__ = 100
+
+    shape: tuple[int, int]
+    words: np.ndarray
+
+    def __init__(self, shape: tuple[int, int], words: np.ndarray | None = None):
+        rows, cols = shape
+        self.shape = (rows, cols)
+        if words is None:
+            words = np.zeros((rows, _words_number(cols)), dtype=_WORD)
+        self.words = words
+
+    @classmethod
+    def identity(cls, n: int) -> "BitMatrix":
+        indices = np.arange(n)
+        return cls.from_coords((n, n), indices, indices)
+
+    @classmethod
+    def from_coords(
+        cls, shape: tuple[int, int], rows: np.ndarray, cols: np.ndarray
+    ) -> "BitMatrix":
+        mat = cls(shape)
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        bits = np.left_shift(np.uint64(1), (cols % WORD_BITS).astype(np.uint64))
+        np.bitwise_or.at(mat.words, (rows, cols // WORD_BITS), bits)
+        return mat
+
+    @classmethod
+    def from_dense(cls, arr: np.ndarray) -> "BitMatrix":
+        arr = np.asarray(arr, dtype=bool)
+        rows, cols = arr.shape
+        packed = np.packbits(arr, axis=1, bitorder="little")
+        padded = np.zeros((rows, _words_number(cols) * 8), dtype=np.uint8)
+        padded[:, : packed.shape[1]] = packed
+        return cls((rows, cols), padded.view(_WORD))
+
+    @classmethod
+    def from_sparse(cls, mat: Any) -> "BitMatrix":
+        coo = csr_matrix(mat, dtype=bool).tocoo()
+        # explicitly stored zeros are not set bits
+        stored = coo.data.astype(bool, copy=False)
+        return cls.from_coords(coo.shape, coo.row[stored], coo.col[stored])
+
+    @classmethod
+    def vstack(cls, blocks: Iterable["BitMatrix"]) -> "BitMatrix":
+        blocks = list(blocks)
+        cols = blocks[0].shape[1]
+        words = np.concatenate([block.words for block in blocks])
+        return cls((len(words), cols), words)
+
+    def _unpacked_chunks(self) -> Iterable[tuple[int, np.ndarray]]:
+        rows, cols = self.shape
+        step = max(1, UNPACK_CHUNK_CELLS // max(cols, 1))
+        for first in range(0, rows, step):
+            chunk = self.words[first : first + step].view(np.uint8)
+            yield first, np.unpackbits(chunk, axis=1, bitorder="little")[:, :cols]
+
+    def nonzero(self) -> tuple[np.ndarray, np.ndarray]:
+        all_rows, all_cols = [np.zeros(0, dtype=np.int64)], [np.zeros(0, np.int64)]
+        for first, chunk in self._unpacked_chunks():
+            rows, cols = np.nonzero(chunk)
+            all_rows.append(rows + first)
+            all_cols.append(cols)
+        return np.concatenate(all_rows), np.concatenate(all_cols)
+
+    def toarray(self) -> np.ndarray:
+        arr = np.zeros(self.shape, dtype=bool)
+        for first, chunk in self._unpacked_chunks():
+            arr[first : first + len(chunk)] = chunk
+        return arr
+
+    def tocsr(self) -> csr_matrix:
+        rows, cols = self.nonzero()
+        data = np.ones(len(rows), dtype=bool)
+        return csr_matrix((data, (rows, cols)), shape=self.shape, dtype=bool)
+
+    def copy(self) -> "BitMatrix":
+        return BitMatrix(self.shape, self.words.copy())
+
+    # a chunk of 64 * k rows becomes k whole words of every row of the
+    # transpose, so the bits are never turned into coordinates
+    def transpose(self) -> "BitMatrix":
+        rows, cols = self.shape
+        result = BitMatrix((cols, rows))
+        step = max(1, UNPACK_CHUNK_CELLS // max(cols, 1) // WORD_BITS) * WORD_BITS
+        for first in range(0, rows, step):
+            chunk = self.words[first : first + step].view(np.uint8)
+            unpacked = np.unpackbits(chunk, axis=1, bitorder="little")[:, :cols]
+            words = BitMatrix.from_dense(np.ascontiguousarray(unpacked.T)).words
+            word = first // WORD_BITS
+            result.words[:, word : word + words.shape[1]] = words
+        return result
+
+    @property
+    def T(self) -> "BitMatrix":
+        return self.transpose()
+
+    @property
+    def nnz(self) -> int:
+        return int(_POPCOUNT[self.words.view(np.uint8)].sum())
+
+    def count_nonzero(self) -> int:
+        return self.nnz
+
+    def any(self) -> bool:
+        return bool(self.words.any())
+
+    def _as_bits(self, other: Any) -> "BitMatrix":
+        if isinstance(other, BitMatrix):
+            bits = other
+        elif issparse(other):
+            bits = BitMatrix.from_sparse(other)
+        else:
+            bits = BitMatrix.from_dense(other)
+        if bits.shape != self.shape:
+            raise ValueError(f"shapes {self.shape} and {bits.shape} do not match")
+        return bits
+
+    # elementwise operations, in the meaning they have for boolean csr matrices
+    def __or__(self, other: Any) -> "BitMatrix":
+        return BitMatrix(self.shape, self.words | self._as_bits(other).words)
+
+    def __and__(self, other: Any) -> "BitMatrix":
+        return BitMatrix(self.shape, self.words & self._as_bits(other).words)
+
+    def __sub__(self, other: Any) -> "BitMatrix":
+        return BitMatrix(self.shape, self.words & ~self._as_bits(other).words)
+
+    def __gt__(self, other: Any) -> "BitMatrix":
+        return self - other
+
+    def __lt__(self, other: Any) -> "BitMatrix":
+        return self._as_bits(other) - self
+
+    def __rsub__(self, other: Any) -> "BitMatrix":
+        return self._as_bits(other) - self
+
+    __add__ = __or__
+    __radd__ = __or__
+    __ror__ = __or__
+    __rand__ = __and__
+
+    def __getitem__(self, key: Any) -> Any:
+        if isinstance(key, tuple):
+            row, col = key
+            if isinstance(col, slice) and col == slice(None):
+                return self[row]
+            row, col = int(row), int(col)
+            word = int(self.words[row, col // WORD_BITS])
+            return bool((word >> (col % WORD_BITS)) & 1)
+        if isinstance(key, slice):
+            words = self.words[key]
+            return BitMatrix((len(words), self.shape[1]), words)
+        raise TypeError(f"unsupported index: {key!r}")
+
+    # OR-AND product with the "four Russians" trick: for every 8 rows of
+    # other all 256 of their unions are tabulated, and every row of self
+    # picks one of them by its byte
+    def _matmul_bits(self, other: "BitMatrix") -> "BitMatrix":
+        rows, inner = self.shape
+        if inner != other.shape[0]:
+            raise ValueError(f"shapes {self.shape} and {other.shape} do not align")
+        result = BitMatrix((rows, other.shape[1]))
+        out = result.words
+        a_bytes = self.words.view(np.uint8)
+        table = np.zeros((256, out.shape[1]), dtype=_WORD)
+        for group in range((inner + 7) // 8):
+            idx = a_bytes[:, group]
+            active = np.flatnonzero(idx)
+            if len(active) == 0:
+                continue
+            base = group * 8
+            for bit in range(min(8, inner - base)):
+                table[1 << bit : 2 << bit] = table[: 1 << bit] | other.words[base + bit]
+            out[active] |= table[idx[active]]
+        return result
+
+    def __matmul__(self, other: Any) -> "BitMatrix":
+        if issparse(other):
+            return self.matmul_transposed(csr_matrix(other, dtype=bool).T.tocsr())
+        if not isinstance(other, BitMatrix):
+            other = BitMatrix.from_dense(other)
+        return self._matmul_bits(other)
+
+    # self @ other for a sparse other given as its transpose: rows of the
+    # transposed product are unions of rows of self.T picked by other.T,
+    # so other is never unpacked and the product takes O(nnz) word unions
+    def matmul_transposed(self, other_t: Any) -> "BitMatrix":
+        return (other_t @ self.T).T
+
+    # sparse @ bits: every row is the union of the rows of self it points to
+    def __rmatmul__(self, other: Any) -> "BitMatrix":
+        if not issparse(other):
+            return BitMatrix.from_dense(other)._matmul_bits(self)
+        other = csr_matrix(other, dtype=bool)
+        if not other.data.all():
+            other = other.copy()
+            other.eliminate_zeros()
+        other.sum_duplicates()
+        if other.shape[1] != self.shape[0]:
+            raise ValueError(f"shapes {other.shape} and {self.shape} do not align")
+        result = BitMatrix((other.shape[0], self.shape[1]))
+        # rows of other are taken in chunks, so that the gathered rows
+        # of self stay bounded
+        per_chunk = max(1, GATHER_CHUNK_WORDS // max(self.words.shape[1], 1))
+        first = 0
+        while first < other.shape[0]:
+            last = int(
+                np.searchsorted(other.indptr, other.indptr[first] + per_chunk, "right")
+            )
+            last = min(max(last - 1, first + 1), other.shape[0])
+            indptr = other.indptr[first : last + 1]
+            nonempty = np.flatnonzero(np.diff(indptr))
+            if len(nonempty) > 0:
+                gathered = self.words[other.indices[indptr[0] : indptr[-1]]]
+                starts = indptr[:-1][nonempty] - indptr[0]
+                result.words[first + nonempty] = np.bitwise_or.reduceat(
+                    gathered, starts, axis=0
+                )
+            first = last
+        return result
+
+
+def bit_kron(fst: BitMatrix, snd: BitMatrix) -> BitMatrix:
+    fst_rows, fst_cols = fst.nonzero()
+    snd_rows, snd_cols = snd.nonzero()
+    shape = (fst.shape[0] * snd.shape[0], fst.shape[1] * snd.shape[1])
+    rows = (fst_rows[:, None] * snd.shape[0] + snd_rows[None, :]).ravel()
+    cols = (fst_cols[:, None] * snd.shape[1] + snd_cols[None, :]).ravel()
+    return BitMatrix.from_coords(shape, rows, cols)
@@ -0,0 +1,194 @@
+import os
+import tempfile
+from typing import Any
+
+import numpy as np
+from scipy.sparse import csr_matrix, hstack, vstack
+
+from project.bit_matrix import WORD_BITS, BitMatrix
+from project.matrix_backend import nnz, to_csr
+
+# tiles that are in memory at once while the closure is computed: the
+# diagonal one, two operands, the updated one and the product with its
+# gather buffer
+TILE_BUFFERS = 6
+
+_WORD = np.dtype("<u8")
+
+
+def tile_bytes(block_size: int) -> int:
+    return block_size * ((block_size + WORD_BITS - 1) // WORD_BITS) * _WORD.itemsize
+
+
+# the largest block size, a multiple of 64, whose working set of tiles
+# fits into the budget (in bytes)
+def block_size_for_budget(memory_budget: int) -> int:
+    block_size = WORD_BITS
+    while TILE_BUFFERS * tile_bytes(block_size + WORD_BITS) <= memory_budget:
+        block_size += WORD_BITS
+    return block_size
+
+
+# square boolean matrix cut into block_size x block_size bit-packed tiles,
+# each of them in its own memory-mapped file; empty tiles have no file.
+# Tiles are read only when they are needed, so the matrix never has to
+# fit into memory as a whole
+class TiledMatrix:
+    shape: tuple[int, int]
+    block_size: int
+    directory: str
+
+    def __init__(self, size: int, block_size: int, directory: str | None = None):
+        self.shape = (size, size)
+        self.block_size = block_size
+        self._tmp = None
+        if directory is None:
+            # removed together with the matrix
+            self._tmp = tempfile.TemporaryDirectory(prefix="closure-")
+            directory = self._tmp.name
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        blocks = self.blocks_number
+        self._tile_nnz = np.zeros((blocks, blocks), dtype=np.int64)
+
+    @classmethod
+    def from_sparse(
+        cls, mat: Any, block_size: int, directory: str | None = None
+    ) -> "TiledMatrix":
+        mat = to_csr(mat)
+        tiled = cls(mat.shape[0], block_size, directory)
+        for i in range(tiled.blocks_number):
+            band = mat[tiled._bounds(i)].tocsc()
+            for j in range(tiled.blocks_number):
+                tile = band[:, tiled._bounds(j)]
+                if tile.nnz > 0:
+                    tiled.store(i, j, BitMatrix.from_sparse(tile))
+        return tiled
+
+    @property
+    def blocks_number(self) -> int:
+        return (self.shape[0] + self.block_size - 1) // self.block_size
+
+    @property
+    def nnz(self) -> int:
+        return int(self._tile_nnz.sum())
+
+    def _bounds(self, block: int) -> slice:
+        first = block * self.block_size
+        return slice(first, min(first + self.block_size, self.shape[0]))
+
+    def _tile_shape(self, i: int, j: int) -> tuple[int, int]:
+        rows, cols = self._bounds(i), self._bounds(j)
+        return rows.stop - rows.start, cols.stop - cols.start
+
+    def _path(self, i: int, j: int) -> str:
+        return os.path.join(self.directory, f"tile_{i}_{j}.bin")
+
+    def _mapped(self, i: int, j: int) -> np.memmap:
+        rows, cols = self._tile_shape(i, j)
+        words = (cols + WORD_BITS - 1) // WORD_BITS
+        return np.memmap(self._path(i, j), dtype=_WORD, mode="r", shape=(rows, words))
+
+    def is_empty_tile(self, i: int, j: int) -> bool:
+        return self._tile_nnz[i, j] == 0
+
+    def load(self, i: int, j: int) -> BitMatrix:
+        shape = self._tile_shape(i, j)
+        if self.is_empty_tile(i, j):
+            return BitMatrix(shape)
+        return BitMatrix(shape, np.array(self._mapped(i, j)))
+
+    def store(self, i: int, j: int, tile: BitMatrix):
+        tile_nnz = tile.nnz
+        if tile_nnz == 0:
+            if not self.is_empty_tile(i, j):
+                os.remove(self._path(i, j))
+        else:
+            mapped = np.memmap(
+                self._path(i, j), dtype=_WORD, mode="w+", shape=tile.words.shape
+            )
+            mapped[:] = tile.words
+            mapped.flush()
+            del mapped
+        self._tile_nnz[i, j] = tile_nnz
+
+    def __getitem__(self, key: tuple[int, int]) -> bool:
+        row, col = (int(index) for index in key)
+        i, j = row // self.block_size, col // self.block_size
+        if self.is_empty_tile(i, j):
+            return False
+        local_row, local_col = row % self.block_size, col % self.block_size
+        word = int(self._mapped(i, j)[local_row, local_col // WORD_BITS])
+        return bool((word >> (local_col % WORD_BITS)) & 1)
+
+    # the given rows as a csr matrix, only the pages of these rows are read
+    def rows(self, rows: np.ndarray) -> csr_matrix:
+        rows = np.asarray(rows, dtype=np.int64)
+        positions, parts = [], []
+        for i in range(self.blocks_number):
+            bounds = self._bounds(i)
+            inside = np.flatnonzero((rows >= bounds.start) & (rows < bounds.stop))
+            if len(inside) == 0:
+                continue
+            local = rows[inside] - bounds.start
+            band = []
+            for j in range(self.blocks_number):
+                cols = self._tile_shape(i, j)[1]
+                if self.is_empty_tile(i, j):
+                    band.append(csr_matrix((len(local), cols), dtype=bool))
+                    continue
+                words = np.array(self._mapped(i, j)[local])
+                band.append(BitMatrix((len(local), cols), words).tocsr())
+            positions.append(inside)
+            parts.append(hstack(band, format="csr", dtype=bool))
+        if not parts:
+            return csr_matrix((len(rows), self.shape[1]), dtype=bool)
+        stacked = vstack(parts, format="csr", dtype=bool)
+        # back to the order the rows were asked in
+        return stacked[np.argsort(np.concatenate(positions))]
+
+    def tocsr(self) -> csr_matrix:
+        return self.rows(np.arange(self.shape[0]))
+
+
+# reflexive-transitive closure of a single tile by squaring
+def _tile_closure(tile: BitMatrix) -> BitMatrix:
+    while True:
+        squared = tile @ tile
+        if squared.nnz == tile.nnz:
+            return squared
+        tile = squared
+
+
+# reflexive-transitive closure of a reflexive step matrix, blocked like
+# Floyd-Warshall: in round k the paths through the k-th block of states
+# are added, first to the k-th block row and column, then to the other
+# tiles; tiles are loaded one by one, so at most TILE_BUFFERS of them
+# are in memory, and products with empty tiles are skipped
+def blocked_transitive_closure(
+    step: Any, memory_budget: int, directory: str | None = None
+) -> TiledMatrix:
+    block_size = block_size_for_budget(memory_budget)
+    closure = TiledMatrix.from_sparse(step, block_size, directory)
+    blocks = range(closure.blocks_number)
+    for k in blocks:
+        diagonal = _tile_closure(closure.load(k, k))
+        closure.store(k, k, diagonal)
+        for j in blocks:
+            if j != k and not closure.is_empty_tile(k, j):
+                closure.store(k, j, diagonal @ closure.load(k, j))
+        for i in blocks:
+            if i != k and not closure.is_empty_tile(i, k):
+                closure.store(i, k, closure.load(i, k) @ diagonal)
+        del diagonal
+        for i in blocks:
+            if i == k or closure.is_empty_tile(i, k):
+                continue
+            left = closure.load(i, k)
+            for j in blocks:
+                if j == k or closure.is_empty_tile(k, j):
+                    continue
+                product = left @ closure.load(k, j)
+                if nnz(product) > 0:
+                    closure.store(i, j, closure.load(i, j) | product)
+    return closure
@@ -0,0 +1,196 @@
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Any, Iterable
+
+import numpy as np
+from scipy.sparse import csr_matrix, identity, issparse, kron, vstack
+
+from project.bit_matrix import BitMatrix, bit_kron
+
+
+# boolean matrices of the automata code come in several representations;
+# a backend knows how to build and combine matrices of its own kind,
+# arithmetic itself goes through the operators (+, >, <, @, slicing)
+class MatrixBackend(ABC):
+    name: str
+
+    @abstractmethod
+    def owns(self, mat: Any) -> bool:
+        pass
+
+    @abstractmethod
+    def convert(self, mat: Any) -> Any:
+        pass
+
+    def from_coords(
+        self, shape: tuple[int, int], rows: np.ndarray, cols: np.ndarray
+    ) -> Any:
+        data = np.ones(len(rows), dtype=bool)
+        return self.convert(csr_matrix((data, (rows, cols)), shape=shape, dtype=bool))
+
+    def identity(self, n: int) -> Any:
+        return self.convert(identity(n, format="csr", dtype=bool))
+
+    def zeros(self, shape: tuple[int, int]) -> Any:
+        return self.convert(csr_matrix(shape, dtype=bool))
+
+    def kron(self, fst: Any, snd: Any) -> Any:
+        return self.convert(kron(to_csr(fst), to_csr(snd), format="csr"))
+
+    def vstack(self, blocks: Iterable[Any]) -> Any:
+        return self.convert(vstack([to_csr(block) for block in blocks], format="csr"))
+
+
+class ScipyBackend(MatrixBackend):
+    def __init__(self, fmt: str):
+        self.name = fmt
+
+    def owns(self, mat: Any) -> bool:
+        return issparse(mat) and mat.format == self.name
+
+    def convert(self, mat: Any) -> Any:
+        if self.owns(mat):
+            return mat
+        return to_csr(mat).asformat(self.name)
+
+    def identity(self, n: int) -> Any:
+        return identity(n, format=self.name, dtype=bool)
+
+    def kron(self, fst: Any, snd: Any) -> Any:
+        return kron(self.convert(fst), self.convert(snd), format=self.name)
+
+
+class DenseBackend(MatrixBackend):
+    name = "dense"
+
+    def owns(self, mat: Any) -> bool:
+        return isinstance(mat, np.ndarray)
+
+    def convert(self, mat: Any) -> Any:
+        if isinstance(mat, np.ndarray):
+            return mat.astype(bool, copy=False)
+        return mat.toarray()
+
+    def identity(self, n: int) -> Any:
+        return np.eye(n, dtype=bool)
+
+    def zeros(self, shape: tuple[int, int]) -> Any:
+        return np.zeros(shape, dtype=bool)
+
+    def kron(self, fst: Any, snd: Any) -> Any:
+        return np.kron(self.convert(fst), self.convert(snd))
+
+    def vstack(self, blocks: Iterable[Any]) -> Any:
+        return np.vstack([self.convert(block) for block in blocks])
+
+
+class BitBackend(MatrixBackend):
+    name = "bits"
+
+    def owns(self, mat: Any) -> bool:
+        return isinstance(mat, BitMatrix)
+
+    def convert(self, mat: Any) -> Any:
+        if isinstance(mat, BitMatrix):
+            return mat
+        if isinstance(mat, np.ndarray):
+            return BitMatrix.from_dense(mat)
+        return BitMatrix.from_sparse(mat)
+
+    def from_coords(
+        self, shape: tuple[int, int], rows: np.ndarray, cols: np.ndarray
+    ) -> Any:
+        return BitMatrix.from_coords(shape, rows, cols)
+
+    def identity(self, n: int) -> Any:
+        return BitMatrix.identity(n)
+
+    def zeros(self, shape: tuple[int, int]) -> Any:
+        return BitMatrix(shape)
+
+    def kron(self, fst: Any, snd: Any) -> Any:
+        return bit_kron(self.convert(fst), self.convert(snd))
+
+    def vstack(self, blocks: Iterable[Any]) -> Any:
+        return BitMatrix.vstack([self.convert(block) for block in blocks])
+
+
+# LIL and DOK are meant for building matrices cell by cell
+BACKENDS: dict[str, MatrixBackend] = {
+    backend.name: backend
+    for backend in [
+        ScipyBackend("csr"),
+        ScipyBackend("csc"),
+        ScipyBackend("lil"),
+        ScipyBackend("dok"),
+        DenseBackend(),
+        BitBackend(),
+    ]
+}
+
+
+def get_backend(name: str) -> MatrixBackend:
+    if name not in BACKENDS:
+        raise ValueError(f"unknown matrix backend: {name}")
+    return BACKENDS[name]
+
+
+def backend_of(mat: Any) -> MatrixBackend:
+    if isinstance(mat, BitMatrix):
+        return BACKENDS["bits"]
+    if isinstance(mat, np.ndarray):
+        return BACKENDS["dense"]
+    return BACKENDS.get(mat.format, BACKENDS["csr"])
+
+
+def to_csr(mat: Any) -> csr_matrix:
+    if isinstance(mat, BitMatrix):
+        return mat.tocsr()
+    # matrices that are not kept in memory, like a tiled closure
+    if not issparse(mat) and hasattr(mat, "tocsr"):
+        return mat.tocsr()
+    return csr_matrix(mat, dtype=bool)
+
+
+def nnz(mat: Any) -> int:
+    if isinstance(mat, np.ndarray):
+        return int(np.count_nonzero(mat))
+    return mat.nnz
+
+
+def density(mat: Any) -> float:
+    rows, cols = mat.shape
+    return nnz(mat) / max(rows * cols, 1)
+
+
+# boolean product; two dense operands go through BLAS, a dense and a scipy
+# operand through scipy, so the sparse one is never unpacked, the rest through @
+def matmul(fst: Any, snd: Any) -> Any:
+    fst_dense, snd_dense = isinstance(fst, np.ndarray), isinstance(snd, np.ndarray)
+    if (fst_dense and issparse(snd)) or (issparse(fst) and snd_dense):
+        return np.asarray(fst @ snd) > 0
+    if fst_dense or snd_dense:
+        dense = BACKENDS["dense"]
+        fst = dense.convert(fst).astype(np.float32)
+        snd = dense.convert(snd).astype(np.float32)
+        return (fst @ snd) > 0
+    return fst @ snd
+
+
+# keeps a matrix sparse while it is sparse and switches it to the dense
+# representation once its density reaches the threshold; it only goes back
+# below half of the threshold, so it does not flip every round
+@dataclass
+class DensityPolicy:
+    sparse: str = "csr"
+    dense: str = "bits"
+    threshold: float = 0.05
+
+    def adapt(self, mat: Any) -> Any:
+        dense = get_backend(self.dense)
+        current = density(mat)
+        if current >= self.threshold or (
+            dense.owns(mat) and current >= self.threshold / 2
+        ):
+            return dense.convert(mat)
+        return get_backend(self.sparse).convert(mat)
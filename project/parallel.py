@@ -0,0 +1,70 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Iterable
+
+# per-label matrix work is run in a thread pool: the sparse kernels of
+# scipy release the GIL, so labels are processed concurrently;
+# workers=None means one thread per CPU, workers=1 means no pool at all
+
+_inside_pool = threading.local()
+
+
+def resolve_workers(workers: int | None) -> int:
+    if workers is None:
+        return os.cpu_count() or 1
+    if workers < 1:
+        raise ValueError(f"workers must be positive, got {workers}")
+    return workers
+
+
+@lru_cache(maxsize=None)
+def _executor(workers: int) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="labels")
+
+
+def _in_pool(func: Callable[[Any], Any], item: Any) -> Any:
+    _inside_pool.active = True
+    try:
+        return func(item)
+    finally:
+        _inside_pool.active = False
+
+
+# [func(item) for item in items], results in the order of items whatever
+# the order they are computed in; nested calls from a pool thread run
+# sequentially, so the pool never waits on itself
+def parallel_map(
+    func: Callable[[Any], Any], items: Iterable[Any], workers: int | None = None
+) -> list[Any]:
+    items = list(items)
+    workers = min(resolve_workers(workers), len(items))
+    if workers <= 1 or getattr(_inside_pool, "active", False):
+        return [func(item) for item in items]
+    pool = _executor(workers)
+    return list(pool.map(lambda item: _in_pool(func, item), items))
+
+
+# {label: func(label)}, labels are taken in a fixed order
+def map_labels(
+    func: Callable[[Any], Any], labels: Iterable[Any], workers: int | None = None
+) -> dict[Any, Any]:
+    labels = sorted(labels, key=repr)
+    return dict(zip(labels, parallel_map(func, labels, workers)))
+
+
+# sum of the matrices by pairwise rounds, the pairs of a round are added
+# concurrently; the pairing depends only on the order of the matrices
+def parallel_sum(matrices: Iterable[Any], workers: int | None = None) -> Any:
+    matrices = list(matrices)
+    if len(matrices) == 0:
+        raise ValueError("nothing to sum")
+    while len(matrices) > 1:
+        pairs = [matrices[i : i + 2] for i in range(0, len(matrices), 2)]
+        matrices = parallel_map(
+            lambda pair: pair[0] + pair[1] if len(pair) == 2 else pair[0],
+            pairs,
+            workers,
+        )
+    return matrices[0]
@@ -0,0 +1,148 @@
+from typing import Any, Iterable, Iterator
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from project.matrix_backend import to_csr
+
+
+def node_array(nodes: Iterable[Any]) -> np.ndarray:
+    nodes = list(nodes)
+    try:
+        arr = np.asarray(nodes) if nodes else np.zeros(0, dtype=np.int64)
+    except ValueError:
+        arr = None
+    if arr is None or arr.ndim != 1 or arr.dtype.kind not in "iub":
+        # tuples, strings and mixed nodes are kept as they are
+        arr = np.empty(len(nodes), dtype=object)
+        arr[:] = nodes
+    return arr
+
+
+def _same_nodes(fst: np.ndarray, snd: np.ndarray) -> bool:
+    return fst is snd or (fst.dtype == snd.dtype and np.array_equal(fst, snd))
+
+
+# answer of a reachability query kept as a boolean matrix over node
+# indices: (row_nodes[i], col_nodes[j]) is an answer iff matrix[i, j];
+# pairs are boxed into Python tuples only when they are asked for
+class ReachabilityResult:
+    matrix: csr_matrix
+    row_nodes: np.ndarray
+    col_nodes: np.ndarray
+
+    def __init__(self, matrix: Any, row_nodes: np.ndarray, col_nodes: np.ndarray):
+        self.matrix = csr_matrix(matrix, dtype=bool)
+        if not self.matrix.data.all():
+            # the matrix may share its arrays with the caller's one
+            self.matrix = self.matrix.copy()
+            self.matrix.eliminate_zeros()
+        self.row_nodes = row_nodes
+        self.col_nodes = col_nodes
+        self._row_index = None
+        self._col_index = None
+
+    @classmethod
+    def from_indices(
+        cls,
+        rows: np.ndarray,
+        cols: np.ndarray,
+        row_nodes: np.ndarray,
+        col_nodes: np.ndarray,
+    ) -> "ReachabilityResult":
+        matrix = csr_matrix(
+            (np.ones(len(rows), dtype=bool), (rows, cols)),
+            shape=(len(row_nodes), len(col_nodes)),
+            dtype=bool,
+        )
+        return cls(matrix, row_nodes, col_nodes)
+
+    @classmethod
+    def from_pairs(
+        cls, pairs: Iterable[tuple[Any, Any]], nodes: Iterable[Any]
+    ) -> "ReachabilityResult":
+        nodes = node_array(nodes)
+        index_of_node = {node: index for index, node in enumerate(nodes.tolist())}
+        rows, cols = [], []
+        for fst, snd in pairs:
+            rows.append(index_of_node[fst])
+            cols.append(index_of_node[snd])
+        return cls.from_indices(
+            np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64), nodes, nodes
+        )
+
+    def __len__(self) -> int:
+        return self.matrix.nnz
+
+    def __contains__(self, pair: Any) -> bool:
+        if self._row_index is None:
+            self._row_index = {
+                node: i for i, node in enumerate(self.row_nodes.tolist())
+            }
+            self._col_index = {
+                node: i for i, node in enumerate(self.col_nodes.tolist())
+            }
+        try:
+            fst, snd = pair
+            row, col = self._row_index.get(fst), self._col_index.get(snd)
+        except (TypeError, ValueError):
+            return False
+        if row is None or col is None:
+            return False
+        return bool(self.matrix[row, col])
+
+    def to_numpy(self) -> tuple[np.ndarray, np.ndarray]:
+        rows, cols = self.matrix.nonzero()
+        return self.row_nodes[rows], self.col_nodes[cols]
+
+    def __iter__(self) -> Iterator[tuple[Any, Any]]:
+        sources, targets = self.to_numpy()
+        return zip(sources.tolist(), targets.tolist())
+
+    def to_set(self) -> set[tuple[Any, Any]]:
+        return set(iter(self))
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, ReachabilityResult):
+            if _same_nodes(self.row_nodes, other.row_nodes) and _same_nodes(
+                self.col_nodes, other.col_nodes
+            ):
+                return (self.matrix != other.matrix).nnz == 0
+            return self.to_set() == other.to_set()
+        if isinstance(other, (set, frozenset)):
+            return len(other) == len(self) and all(pair in self for pair in other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"ReachabilityResult({len(self)} pairs)"
+
+
+def _mask_indices(mask: np.ndarray | None, size: int) -> np.ndarray:
+    if mask is None:
+        return np.arange(size)
+    return np.flatnonzero(mask)
+
+
+# answers of an engine out of its reachability matrix: reached[i, j] means
+# that the answer (nodes[row_nodes[i]], nodes[col_nodes[j]]) is found,
+# provided that row i and column j are set in the masks
+def extract_answers(
+    reached: Any,
+    nodes: np.ndarray,
+    row_nodes: np.ndarray,
+    col_nodes: np.ndarray,
+    row_mask: np.ndarray | None = None,
+    col_mask: np.ndarray | None = None,
+    as_matrix: bool = False,
+) -> set[tuple[Any, Any]] | ReachabilityResult:
+    reached = to_csr(reached)
+    rows = _mask_indices(row_mask, reached.shape[0])
+    cols = _mask_indices(col_mask, reached.shape[1])
+    hit_rows, hit_cols = reached[rows][:, cols].nonzero()
+    sources = row_nodes[rows[hit_rows]]
+    targets = col_nodes[cols[hit_cols]]
+    if as_matrix:
+        return ReachabilityResult.from_indices(sources, targets, nodes, nodes)
+    return set(zip(nodes[sources].tolist(), nodes[targets].tolist()))
@@ -1,11 +1,39 @@
-from typing import List, Tuple
-from dataclasses import dataclass
+import hashlib
+import json
+import os
+import re
+import zipfile
+from pathlib import Path
+from typing import Callable, Iterator, List, Tuple
+from dataclasses import asdict, dataclass
 from networkx import MultiDiGraph
 from pyparsing import Any
-from networkx.drawing.nx_pydot import write_dot
+from scipy.sparse import csr_matrix
 
+import numpy as np
+import pandas as pd
 import cfpq_data as cfpq
 
+GRAPH_CACHE_DIR = Path(
+    os.environ.get(
+        "FORMAL_LANG_COURSE_GRAPH_CACHE",
+        Path.home() / ".cache" / "formal-lang-course" / "graphs",
+    )
+)
+CSV_CHUNK_SIZE = 1 << 20
+EXPORT_BLOCK_SIZE = 1 << 16
+_CHECKSUM_CHUNK_SIZE = 1 << 20
+
+_DOT_ID = r'"(?:[^"\\]|\\.)*"|[^\s\[\];,"=]+'
+_DOT_PLAIN_ID = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+_DOT_NUMERAL = re.compile(r"[0-9]+(?:\.[0-9]*)?|\.[0-9]+")
+_DOT_KEYWORDS = frozenset({"node", "edge", "graph", "digraph", "subgraph", "strict"})
+_DOT_STATEMENT = re.compile(rf"({_DOT_ID})(?:\s*->\s*({_DOT_ID}))?\s*(?:\[(.*)\])?\s*;")
+_DOT_ATTR = re.compile(rf"({_DOT_ID})=({_DOT_ID})")
+_DOT_FRAME = re.compile(r"(?:digraph\s*\{|\}|)")
+_DOT_ESCAPE = re.compile(r"\\(.)", re.DOTALL)
+_DOT_ESCAPED = {"n": "\n", "r": "\r"}
+
 
 @dataclass
 class GraphMetaData:
@@ -14,24 +42,547 @@ class GraphMetaData:
     labels: List[Any]
 
 
-def _load_graph_by_name(graph_name: str) -> MultiDiGraph:
+# per-label lists are aligned with labels, which are sorted
+# as in cfpq.get_sorted_labels; density is edges / nodes^2
+@dataclass
+class GraphStatistics:
+    nodes_number: int
+    edges_number: int
+    labels: List[Any]
+    label_frequency: List[int]
+    label_sources: List[int]
+    label_targets: List[int]
+    label_density: List[float]
+    max_out_degree: int
+    max_in_degree: int
+    mean_degree: float
+    checksum: str
+
+    def to_meta_data(self) -> GraphMetaData:
+        return GraphMetaData(self.nodes_number, self.edges_number, self.labels)
+
+
+# nodes[i] is the graph node behind the i-th row/column of every matrix
+@dataclass
+class GraphMatrices:
+    nodes: np.ndarray
+    matrices: dict[Any, csr_matrix]
+
+
+# edges are grouped by label: edges of labels[i] are
+# sources/targets[label_offsets[i] : label_offsets[i + 1]],
+# sources and targets hold positions in nodes, not node ids
+@dataclass
+class CachedGraph:
+    nodes: np.ndarray
+    labels: List[Any]
+    label_offsets: np.ndarray
+    sources: np.ndarray
+    targets: np.ndarray
+    checksum: str
+
+    def number_of_nodes(self) -> int:
+        return len(self.nodes)
+
+    def number_of_edges(self) -> int:
+        return len(self.sources)
+
+    def edges_of(self, label: Any) -> Tuple[np.ndarray, np.ndarray]:
+        i = self.labels.index(label)
+        begin, end = self.label_offsets[i], self.label_offsets[i + 1]
+        return self.sources[begin:end], self.targets[begin:end]
+
+    def to_matrices(self) -> GraphMatrices:
+        matrices = dict()
+        for label in self.labels:
+            sources, targets = self.edges_of(label)
+            matrices[label] = edges_to_bool_matrix(
+                self.number_of_nodes(), sources, targets
+            )
+        return GraphMatrices(self.nodes, matrices)
+
+    def to_multidigraph(self) -> MultiDiGraph:
+        nodes = self.nodes.tolist()
+        graph = MultiDiGraph()
+        graph.add_nodes_from(nodes)
+        for label in self.labels:
+            sources, targets = self.edges_of(label)
+            graph.add_edges_from(
+                (nodes[fst], nodes[snd], {"label": label})
+                for fst, snd in zip(sources.tolist(), targets.tolist())
+            )
+        return graph
+
+
+def _file_checksum(path: Path) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHECKSUM_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _graph_cache_path(graph_name: str, cache_dir: Path | None = None) -> Path:
+    if cache_dir is None:
+        cache_dir = GRAPH_CACHE_DIR
+    return Path(cache_dir) / f"{graph_name}.npz"
+
+
+def _graph_statistics_path(graph_name: str, cache_dir: Path | None = None) -> Path:
+    return _graph_cache_path(graph_name, cache_dir).with_suffix(".meta.json")
+
+
+def _stream_csv_edges(
+    path: Path, chunk_size: int, index_of_node: dict[Any, int]
+) -> Iterator[Tuple[Any, np.ndarray, np.ndarray]]:
+    # nodes are numbered in order of first appearance, as in cfpq.graph_from_csv;
+    # index_of_node is filled in place while the file is read
+    chunks = pd.read_csv(
+        path,
+        sep=" ",
+        header=None,
+        names=["from", "to", "label"],
+        # every chunk would infer its own column types, so values are kept
+        # as strings here and typed once the whole file is read
+        dtype=str,
+        # tokens such as NA or null are node ids and labels, not missing values
+        keep_default_na=False,
+        na_filter=False,
+        engine="c",
+        chunksize=chunk_size,
+    )
+    for chunk in chunks:
+        ends = chunk[["from", "to"]].to_numpy().ravel()
+        codes, chunk_nodes = pd.factorize(ends)
+        if (codes == -1).any():
+            raise ValueError(f"Edge without an endpoint in {path}")
+        chunk_indices = np.fromiter(
+            (
+                index_of_node.setdefault(node, len(index_of_node))
+                for node in chunk_nodes.tolist()
+            ),
+            dtype=np.int64,
+            count=len(chunk_nodes),
+        )
+        ends = chunk_indices[codes].reshape(-1, 2)
+
+        label_codes, chunk_labels = pd.factorize(chunk["label"])
+        if (label_codes == -1).any():
+            raise ValueError(f"Edge without a label in {path}")
+        for i, label in enumerate(chunk_labels.tolist()):
+            mask = label_codes == i
+            yield label, ends[mask, 0], ends[mask, 1]
+
+
+# a column is numeric only if all of its values are, as when pandas reads
+# the whole file at once; the result does not depend on the chunk size
+def _csv_column_values(values: List[str]) -> List[Any]:
+    try:
+        return pd.to_numeric(pd.Series(values, dtype=object)).tolist()
+    except (ValueError, TypeError):
+        return values
+
+
+def _read_csv_edges_by_label(
+    path: Path, chunk_size: int = CSV_CHUNK_SIZE
+) -> Tuple[np.ndarray, dict[Any, Tuple[np.ndarray, np.ndarray]]]:
+    index_of_node = dict()
+    chunks_by_label = dict()
+    for label, sources, targets in _stream_csv_edges(path, chunk_size, index_of_node):
+        chunks_by_label.setdefault(label, []).append((sources, targets))
+
+    # spellings like "1" and "01" become the same node once typed
+    node_values = _csv_column_values(list(index_of_node))
+    index_of_value = dict()
+    renumber = np.fromiter(
+        (index_of_value.setdefault(node, len(index_of_value)) for node in node_values),
+        dtype=np.int64,
+        count=len(node_values),
+    )
+
+    label_values = _csv_column_values(list(chunks_by_label))
+    edges_by_label = dict()
+    for label, chunks in zip(label_values, chunks_by_label.values()):
+        edges_by_label.setdefault(label, []).extend(chunks)
+    for label, chunks in edges_by_label.items():
+        edges_by_label[label] = (
+            renumber[np.concatenate([sources for sources, _ in chunks])],
+            renumber[np.concatenate([targets for _, targets in chunks])],
+        )
+    return np.array(list(index_of_value)), edges_by_label
+
+
+def _csv_to_cached(path: Path, checksum: str) -> CachedGraph:
+    nodes, edges_by_label = _read_csv_edges_by_label(path)
+    labels = sorted(edges_by_label)
+
+    label_offsets = np.zeros(len(labels) + 1, dtype=np.int64)
+    for i, label in enumerate(labels):
+        label_offsets[i + 1] = label_offsets[i] + len(edges_by_label[label][0])
+    empty = np.empty(0, dtype=np.int64)
+    sources = np.concatenate([empty] + [edges_by_label[lbl][0] for lbl in labels])
+    targets = np.concatenate([empty] + [edges_by_label[lbl][1] for lbl in labels])
+
+    return CachedGraph(nodes, labels, label_offsets, sources, targets, checksum)
+
+
+def edges_to_bool_matrix(
+    nodes_number: int, sources: np.ndarray, targets: np.ndarray
+) -> csr_matrix:
+    data = np.ones(len(sources), dtype=bool)
+    return csr_matrix(
+        (data, (sources, targets)), shape=(nodes_number, nodes_number), dtype=bool
+    )
+
+
+def graph_matrices_from_csv(
+    path: Path, chunk_size: int = CSV_CHUNK_SIZE
+) -> GraphMatrices:
+    nodes, edges_by_label = _read_csv_edges_by_label(path, chunk_size)
+    matrices = dict()
+    for label, (sources, targets) in edges_by_label.items():
+        matrices[label] = edges_to_bool_matrix(len(nodes), sources, targets)
+    return GraphMatrices(nodes, matrices)
+
+
+def _tmp_path(path: Path) -> Path:
+    # cache files are written to a temporary file first and then moved,
+    # so that a concurrent reader never sees a half-written file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path.with_name(f"{path.name}.{os.getpid()}.tmp")
+
+
+def _write_graph_cache(cached: CachedGraph, path: Path):
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            nodes=cached.nodes,
+            # labels keep their dtype: numeric labels of a CSV stay numbers
+            labels=np.array(cached.labels),
+            label_offsets=cached.label_offsets,
+            sources=cached.sources,
+            targets=cached.targets,
+            checksum=np.array(cached.checksum),
+        )
+    os.replace(tmp_path, path)
+
+
+def _read_graph_cache(path: Path) -> CachedGraph | None:
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            return CachedGraph(
+                data["nodes"],
+                data["labels"].tolist(),
+                data["label_offsets"],
+                data["sources"],
+                data["targets"],
+                str(data["checksum"]),
+            )
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        # a missing or broken cache is simply rebuilt
+        return None
+
+
+def _sorted_labels(labels: List[Any], frequency: List[int]) -> List[Any]:
+    # same order as cfpq.get_sorted_labels: by usage, then lexicographically
+    pairs = sorted(zip(labels, frequency), key=lambda x: (-x[1], x[0]))
+    return [label for label, _ in pairs]
+
+
+def _compute_graph_statistics(cached: CachedGraph) -> GraphStatistics:
+    nodes_number = cached.number_of_nodes()
+    edges_number = cached.number_of_edges()
+    labels = _sorted_labels(cached.labels, np.diff(cached.label_offsets).tolist())
+
+    label_frequency, label_sources, label_targets, label_density = [], [], [], []
+    for label in labels:
+        sources, targets = cached.edges_of(label)
+        label_frequency.append(len(sources))
+        label_sources.append(len(np.unique(sources)))
+        label_targets.append(len(np.unique(targets)))
+        label_density.append(len(sources) / max(nodes_number, 1) ** 2)
+
+    out_degree = np.bincount(cached.sources, minlength=nodes_number)
+    in_degree = np.bincount(cached.targets, minlength=nodes_number)
+    return GraphStatistics(
+        nodes_number,
+        edges_number,
+        labels,
+        label_frequency,
+        label_sources,
+        label_targets,
+        label_density,
+        int(out_degree.max(initial=0)),
+        int(in_degree.max(initial=0)),
+        edges_number / max(nodes_number, 1),
+        cached.checksum,
+    )
+
+
+def _write_graph_statistics(stats: GraphStatistics, path: Path):
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, "w") as f:
+        json.dump(asdict(stats), f)
+    os.replace(tmp_path, path)
+
+
+def _read_graph_statistics(path: Path) -> GraphStatistics | None:
+    try:
+        with open(path) as f:
+            return GraphStatistics(**json.load(f))
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def _build_graph_cache(
+    graph_name: str, graph_path: Path, checksum: str, cache_dir: Path | None
+) -> CachedGraph:
+    cached = _csv_to_cached(graph_path, checksum)
+    _write_graph_cache(cached, _graph_cache_path(graph_name, cache_dir))
+    _write_graph_statistics(
+        _compute_graph_statistics(cached),
+        _graph_statistics_path(graph_name, cache_dir),
+    )
+    return cached
+
+
+def _validated_graph_cache(
+    graph_name: str, graph_path: Path, checksum: str, cache_dir: Path | None
+) -> CachedGraph:
+    cached = _read_graph_cache(_graph_cache_path(graph_name, cache_dir))
+    if cached is not None and cached.checksum == checksum:
+        return cached
+    return _build_graph_cache(graph_name, graph_path, checksum, cache_dir)
+
+
+def load_cached_graph(
+    graph_name: str, cache_dir: Path | None = None, offline: bool = False
+) -> CachedGraph:
+    if offline:
+        cached = _read_graph_cache(_graph_cache_path(graph_name, cache_dir))
+        if cached is not None:
+            return cached
+
     graph_path = cfpq.download(graph_name)
-    return cfpq.graph_from_csv(graph_path)
+    checksum = _file_checksum(graph_path)
+    return _validated_graph_cache(graph_name, graph_path, checksum, cache_dir)
 
 
-def _save_graph_to_dot(graph: MultiDiGraph, path: str):
-    write_dot(graph, path)
+# the sidecar is served as is when it exists, without downloading the
+# graph; refresh checks it against the checksum of a fresh download
+def load_graph_statistics(
+    graph_name: str,
+    cache_dir: Path | None = None,
+    offline: bool = False,
+    refresh: bool = False,
+) -> GraphStatistics:
+    stats_path = _graph_statistics_path(graph_name, cache_dir)
+    stats = _read_graph_statistics(stats_path)
+    if stats is not None and not refresh:
+        return stats
+    if offline:
+        cached = load_cached_graph(graph_name, cache_dir, offline)
+    else:
+        graph_path = cfpq.download(graph_name)
+        checksum = _file_checksum(graph_path)
+        if stats is not None and stats.checksum == checksum:
+            return stats
+        cached = _validated_graph_cache(graph_name, graph_path, checksum, cache_dir)
+
+    # the sidecar is written along with the graph cache, but caches
+    # built before sidecars existed have to get one here
+    stats = _read_graph_statistics(stats_path)
+    if stats is None or stats.checksum != cached.checksum:
+        stats = _compute_graph_statistics(cached)
+        _write_graph_statistics(stats, stats_path)
+    return stats
+
+
+def load_graph_matrices(
+    graph_name: str, cache_dir: Path | None = None, offline: bool = False
+) -> GraphMatrices:
+    return load_cached_graph(graph_name, cache_dir, offline).to_matrices()
+
+
+def load_graph(
+    graph_name: str, cache_dir: Path | None = None, offline: bool = False
+) -> MultiDiGraph:
+    return load_cached_graph(graph_name, cache_dir, offline).to_multidigraph()
+
+
+def _load_graph_by_name(graph_name: str) -> MultiDiGraph:
+    return load_graph(graph_name)
+
+
+# non-negative numerals are written bare, everything else is quoted;
+# line breaks are escaped, so that every statement stays on one line
+def _dot_quote(value: Any) -> str:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if _DOT_NUMERAL.fullmatch(str(value)):
+            return str(value)
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return '"' + value.replace("\n", "\\n").replace("\r", "\\r") + '"'
+
 
+# identifiers are written bare unless they are keywords, in any case
+def _dot_id(value: Any) -> str:
+    if isinstance(value, str) and _DOT_PLAIN_ID.fullmatch(value):
+        if value.lower() not in _DOT_KEYWORDS:
+            return value
+    return _dot_quote(value)
 
-def get_graph_meta_data(graph_name: str) -> GraphMetaData:
-    graph = _load_graph_by_name(graph_name)
-    return GraphMetaData(
-        graph.number_of_nodes(),
-        graph.number_of_edges(),
-        cfpq.get_sorted_labels(graph),
+
+def _dot_attrs(attrs: dict) -> str:
+    if not attrs:
+        return ""
+    return (
+        " ["
+        + ", ".join(f"{_dot_id(k)}={_dot_quote(v)}" for k, v in attrs.items())
+        + "]"
     )
 
 
+def _dot_unquote(value: str) -> str:
+    if value.startswith('"'):
+        return _DOT_ESCAPE.sub(
+            lambda m: _DOT_ESCAPED.get(m.group(1), m.group(1)), value[1:-1]
+        )
+    return value
+
+
+def _dot_value(value: str) -> Any:
+    if value.startswith('"'):
+        return _dot_unquote(value)
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+# nodes are looked up block by block, so no per-node list is built
+def _block_nodes(nodes: np.ndarray, block_size: int) -> Iterator[Any]:
+    for begin in range(0, len(nodes), block_size):
+        yield from nodes[begin : begin + block_size].tolist()
+
+
+def _matrix_edges(
+    matrices: GraphMatrices, node_id: Callable[[Any], str], block_size: int
+) -> Iterator[Tuple[str, Any, str]]:
+    for label, mat in matrices.matrices.items():
+        mat = csr_matrix(mat)
+        # walk the rows in blocks to keep the extra memory bounded by block_size
+        for begin in range(0, mat.shape[0], block_size):
+            end = min(begin + block_size, mat.shape[0])
+            lo, hi = mat.indptr[begin], mat.indptr[end]
+            rows = np.repeat(
+                np.arange(begin, end), np.diff(mat.indptr[begin : end + 1])
+            )
+            present = mat.data[lo:hi].astype(bool)
+            rows, cols = rows[present], mat.indices[lo:hi][present]
+            fst_nodes = matrices.nodes[rows].tolist()
+            snd_nodes = matrices.nodes[cols].tolist()
+            for fst, snd in zip(fst_nodes, snd_nodes):
+                yield node_id(fst), label, node_id(snd)
+
+
+def write_graph_to_dot(graph: MultiDiGraph, path: str):
+    with open(path, "w") as f:
+        f.write("digraph  {\n")
+        f.writelines(
+            f"{_dot_id(node)}{_dot_attrs(attrs)};\n"
+            for node, attrs in graph.nodes(data=True)
+        )
+        f.writelines(
+            f"{_dot_id(fst)} -> {_dot_id(snd)}{_dot_attrs({'key': key, **attrs})};\n"
+            for fst, snd, key, attrs in graph.edges(keys=True, data=True)
+        )
+        f.write("}\n")
+
+
+def write_matrices_to_dot(
+    matrices: GraphMatrices, path: str, block_size: int = EXPORT_BLOCK_SIZE
+):
+    with open(path, "w") as f:
+        f.write("digraph  {\n")
+        f.writelines(
+            f"{_dot_id(node)};\n" for node in _block_nodes(matrices.nodes, block_size)
+        )
+        f.writelines(
+            f"{fst} -> {snd} [label={_dot_quote(label)}];\n"
+            for fst, label, snd in _matrix_edges(matrices, _dot_id, block_size)
+        )
+        f.write("}\n")
+
+
+# same format as the dataset CSV files, so graph_matrices_from_csv
+# and cfpq.graph_from_csv read it back
+def write_graph_to_edge_list(graph: MultiDiGraph, path: str):
+    with open(path, "w") as f:
+        f.writelines(
+            f"{fst} {snd} {label}\n" for fst, snd, label in graph.edges(data="label")
+        )
+
+
+def write_matrices_to_edge_list(
+    matrices: GraphMatrices, path: str, block_size: int = EXPORT_BLOCK_SIZE
+):
+    with open(path, "w") as f:
+        f.writelines(
+            f"{fst} {snd} {label}\n"
+            for fst, label, snd in _matrix_edges(matrices, str, block_size)
+        )
+
+
+# reads the one-statement-per-line DOT written by write_graph_to_dot
+# and write_matrices_to_dot, not arbitrary DOT files
+def read_graph_from_dot(path: str) -> MultiDiGraph:
+    nodes, edges = [], []
+    values = dict()
+    with open(path) as f:
+        for number, line in enumerate(f, start=1):
+            line = line.strip()
+            if _DOT_FRAME.fullmatch(line):
+                continue
+            statement = _DOT_STATEMENT.fullmatch(line)
+            if statement is None:
+                raise ValueError(f"Unsupported DOT statement at {path}:{number}")
+            fst, snd, attrs = statement.groups()
+            attrs = {
+                _dot_unquote(k): _dot_value(v)
+                for k, v in _DOT_ATTR.findall(attrs or "")
+            }
+            if fst not in values:
+                values[fst] = _dot_value(fst)
+            if snd is None:
+                nodes.append((values[fst], attrs))
+                continue
+            if snd not in values:
+                values[snd] = _dot_value(snd)
+            key = attrs.pop("key", None)
+            edges.append((values[fst], values[snd], key, attrs))
+
+    # networkx is much faster at adding everything in bulk
+    graph = MultiDiGraph()
+    graph.add_nodes_from(nodes)
+    graph.add_edges_from(edges)
+    return graph
+
+
+def _save_graph_to_dot(graph: MultiDiGraph, path: str):
+    write_graph_to_dot(graph, path)
+
+
+def get_graph_meta_data(
+    graph_name: str,
+    cache_dir: Path | None = None,
+    offline: bool = False,
+    refresh: bool = False,
+) -> GraphMetaData:
+    stats = load_graph_statistics(graph_name, cache_dir, offline, refresh)
+    return stats.to_meta_data()
+
+
 def create_two_cycles_graph_and_save_to_dot(
     fst_c_node_num: int, snd_c_node_num: int, labels: Tuple[str, str], file_path: str
 ):
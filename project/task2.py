@@ -4,21 +4,331 @@ from pyformlang.finite_automaton import (
     DeterministicFiniteAutomaton,
     NondeterministicFiniteAutomaton,
 )
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
 from networkx import MultiDiGraph
-from pyformlang.regular_expression import Regex
-from typing import Set
+from pyformlang.regular_expression import Regex, MisformedRegexError
+from scipy.sparse import csr_matrix
+from typing import Any, Callable, Set
 
+import re
+import numpy as np
 
 EPSILON = "$"
+REGEX_CACHE_SIZE = 256
 
+# same special symbols as pyformlang's regex syntax
+_REGEX_UNION = ("|", "+")
+_REGEX_EPSILON = ("$", "epsilon")
+_REGEX_OPERATORS = {".", "*", "(", ")", "$"} | set(_REGEX_UNION)
 
-def regex_to_dfa(regex: str) -> DeterministicFiniteAutomaton:
+
+@dataclass
+class RegexCacheInfo:
+    hits: int
+    misses: int
+    evictions: int
+    size: int
+    maxsize: int
+
+
+# state 0 is the only start state, every other state is a position
+# of a symbol in the regex
+@dataclass
+class GlushkovAutomaton:
+    states_number: int
+    final_states: set[int]
+    matrices: dict[str, csr_matrix]
+
+
+def _tokenize_regex(regex: str) -> list[str]:
+    tokens = []
+    word = ""
+    escaped = False
+    for c in regex:
+        if escaped:
+            word += c
+            escaped = False
+        elif c == "\\":
+            word += c
+            escaped = True
+        elif c in _REGEX_OPERATORS or c == " ":
+            # as in pyformlang, only spaces separate symbols
+            if word:
+                tokens.append(word)
+                word = ""
+            if c != " ":
+                tokens.append(c)
+        else:
+            word += c
+    if word:
+        tokens.append(word)
+    return tokens
+
+
+# regex trees are tuples: ("sym", value), ("eps",), ("empty",),
+# ("union", left, right), ("concat", left, right), ("star", tree)
+class _RegexParser:
+    def __init__(self, regex: str):
+        self.regex = regex
+        self.tokens = _tokenize_regex(regex)
+        self.pos = 0
+
+    def parse(self) -> tuple:
+        if not self.tokens:
+            return ("empty",)
+        tree = self._union()
+        if self.pos != len(self.tokens):
+            self._error()
+        return tree
+
+    def _error(self):
+        raise MisformedRegexError("The regex is misformed here.", self.regex)
+
+    def _peek(self) -> str | None:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    # like in pyformlang, a missing right operand of "|" or "." at the end
+    # of the regex or of a group is the empty language: "a|" is "a"
+    def _right_operand(self, operand: Any) -> tuple:
+        if self._peek() in (None, ")"):
+            return ("empty",)
+        return operand()
+
+    def _union(self) -> tuple:
+        tree = self._concat()
+        while self._peek() in _REGEX_UNION:
+            self.pos += 1
+            tree = ("union", tree, self._right_operand(self._concat))
+        return tree
+
+    def _concat(self) -> tuple:
+        tree = self._star()
+        while True:
+            token = self._peek()
+            if token == ".":
+                self.pos += 1
+                tree = ("concat", tree, self._right_operand(self._star))
+                continue
+            if token is None or token in _REGEX_UNION or token in (")", "*"):
+                return tree
+            tree = ("concat", tree, self._star())
+
+    def _star(self) -> tuple:
+        tree = self._atom()
+        while self._peek() == "*":
+            self.pos += 1
+            tree = ("star", tree)
+        return tree
+
+    def _atom(self) -> tuple:
+        token = self._peek()
+        if token is None or (token in _REGEX_OPERATORS and token not in ("(", "$")):
+            self._error()
+        self.pos += 1
+        if token == "(":
+            tree = self._union()
+            if self._peek() != ")":
+                self._error()
+            self.pos += 1
+            return tree
+        if token in _REGEX_EPSILON:
+            return ("eps",)
+        if token.startswith("\\"):
+            token = token[1:]
+        return ("sym", token)
+
+
+def parse_regex(regex: str) -> tuple:
+    return _RegexParser(regex).parse()
+
+
+# returns (nullable, first, last) of the subtree; symbols[p] and follow[p]
+# are filled for every position p met on the way
+def _glushkov_sets(
+    tree: tuple, symbols: list[str], follow: list[set[int]]
+) -> tuple[bool, set[int], set[int]]:
+    kind = tree[0]
+    if kind == "sym":
+        symbols.append(tree[1])
+        follow.append(set())
+        position = len(symbols) - 1
+        return False, {position}, {position}
+    if kind == "eps":
+        return True, set(), set()
+    if kind == "empty":
+        return False, set(), set()
+    if kind == "star":
+        _, first, last = _glushkov_sets(tree[1], symbols, follow)
+        for position in last:
+            follow[position] |= first
+        return True, first, last
+
+    nullable1, first1, last1 = _glushkov_sets(tree[1], symbols, follow)
+    nullable2, first2, last2 = _glushkov_sets(tree[2], symbols, follow)
+    if kind == "union":
+        return nullable1 or nullable2, first1 | first2, last1 | last2
+    for position in last1:
+        follow[position] |= first2
+    first = first1 | first2 if nullable1 else first1
+    last = last1 | last2 if nullable2 else last2
+    return nullable1 and nullable2, first, last
+
+
+# position automaton has no epsilon transitions and exactly
+# one state more than symbol occurrences in the regex
+def tree_to_glushkov(tree: tuple) -> GlushkovAutomaton:
+    symbols = [None]
+    follow = [set()]
+    nullable, first, last = _glushkov_sets(tree, symbols, follow)
+    follow[0] = first
+
+    coords = dict()
+    for fst, positions in enumerate(follow):
+        for snd in positions:
+            sources, targets = coords.setdefault(symbols[snd], ([], []))
+            sources.append(fst)
+            targets.append(snd)
+
+    size = len(symbols)
+    matrices = dict()
+    for symbol, (sources, targets) in coords.items():
+        data = np.ones(len(sources), dtype=bool)
+        matrices[symbol] = csr_matrix(
+            (data, (sources, targets)), shape=(size, size), dtype=bool
+        )
+    final_states = set(last) | ({0} if nullable else set())
+    return GlushkovAutomaton(size, final_states, matrices)
+
+
+# the pyformlang DFA and the regex tree are only built if someone asks
+# for them, while artefacts hold other compiled forms (task3 keeps
+# AdjacencyMatrixFA ones there); on_compiled is called once, when the
+# regex is first compiled without errors, and lock guards the artefacts
+class CompiledRegex:
+    def __init__(
+        self,
+        regex: str,
+        on_compiled: Callable[["CompiledRegex"], None] | None = None,
+        lock: Lock | None = None,
+    ):
+        self.regex = regex
+        self.artefacts: dict[Any, Any] = dict()
+        self._dfa = None
+        self._tree = None
+        self._on_compiled = on_compiled
+        self._lock = lock if lock is not None else Lock()
+
+    def _compiled(self):
+        if self._on_compiled is not None:
+            on_compiled, self._on_compiled = self._on_compiled, None
+            on_compiled(self)
+
+    @property
+    def tree(self) -> tuple:
+        if self._tree is None:
+            self._tree = parse_regex(self.regex)
+            self._compiled()
+        return self._tree
+
+    @property
+    def dfa(self) -> DeterministicFiniteAutomaton:
+        if self._dfa is None:
+            self._dfa = _compile_regex(self.regex)
+            self._compiled()
+        return self._dfa
+
+    # an artefact is built outside the lock, since building it may put
+    # this entry into the cache; the first one stored is kept
+    def artefact(self, key: Any, build: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key in self.artefacts:
+                return self.artefacts[key]
+        value = build()
+        with self._lock:
+            return self.artefacts.setdefault(key, value)
+
+    @property
+    def glushkov(self) -> GlushkovAutomaton:
+        return self.artefact("glushkov", lambda: tree_to_glushkov(self.tree))
+
+
+def _compile_regex(regex: str) -> DeterministicFiniteAutomaton:
     reg = Regex(regex)
     nfa_w_eps = reg.to_epsilon_nfa()
     dfa = nfa_w_eps.to_deterministic()
     return dfa.minimize()
 
 
+# pyformlang splits symbols by spaces only, so runs of spaces can be
+# collapsed without changing the language, but tabs or newlines can not
+def _normalize_regex(regex: str) -> str:
+    return re.sub(" +", " ", regex).strip(" ")
+
+
+class RegexCache:
+    def __init__(self, maxsize: int = REGEX_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, CompiledRegex] = OrderedDict()
+        self._lock = Lock()
+
+    # a missed regex takes a slot only once it compiles, so misformed
+    # regexes do not evict good ones
+    def get(self, regex: str) -> CompiledRegex:
+        key = _normalize_regex(regex)
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return compiled
+
+            self.misses += 1
+            return CompiledRegex(key, self._insert, self._lock)
+
+    def _insert(self, compiled: CompiledRegex):
+        with self._lock:
+            # another caller may have compiled the same regex meanwhile
+            if self.maxsize <= 0 or compiled.regex in self._entries:
+                return
+            self._entries[compiled.regex] = compiled
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def info(self) -> RegexCacheInfo:
+        with self._lock:
+            return RegexCacheInfo(
+                self.hits, self.misses, self.evictions, len(self._entries), self.maxsize
+            )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+REGEX_CACHE = RegexCache()
+
+
+# the cached forms are shared, so callers get copies they may modify
+def regex_to_dfa(regex: str) -> DeterministicFiniteAutomaton:
+    return REGEX_CACHE.get(regex).dfa.copy()
+
+
+def regex_to_glushkov(regex: str) -> GlushkovAutomaton:
+    glushkov = REGEX_CACHE.get(regex).glushkov
+    return GlushkovAutomaton(
+        glushkov.states_number,
+        set(glushkov.final_states),
+        {symbol: mat.copy() for symbol, mat in glushkov.matrices.items()},
+    )
+
+
 def _add_states_to_aut(
     graph: MultiDiGraph,
     start_states: Set[int],
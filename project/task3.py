@@ -1,9 +1,26 @@
-from typing import Iterable
+from dataclasses import dataclass
+from collections.abc import Mapping, Set as AbstractSet
+from typing import Any, Iterable, Iterator
 from networkx import MultiDiGraph
 from pyformlang.finite_automaton import State, Symbol, NondeterministicFiniteAutomaton
-from scipy.sparse import identity, kron, csr_matrix
+from scipy.sparse import csr_matrix, identity, issparse, kron, vstack
 
-from project.task2 import regex_to_dfa, graph_to_nfa
+import numpy as np
+
+from project.bit_matrix import BitMatrix
+from project.blocked_closure import TiledMatrix, blocked_transitive_closure
+from project.matrix_backend import (
+    DensityPolicy,
+    backend_of,
+    get_backend,
+    matmul,
+    nnz,
+    to_csr,
+)
+from project.parallel import map_labels, parallel_sum
+from project.reachability import ReachabilityResult, extract_answers, node_array
+from project.task1 import GraphMatrices, edges_to_bool_matrix
+from project.task2 import EPSILON, REGEX_CACHE
 
 
 class AdjacencyMatrixFA:
@@ -20,23 +37,38 @@ class AdjacencyMatrixFA:
             # * 1 for casting into int for better visibility
             print(f"{symbol}:\n {self.boolean_decompress.get(symbol).toarray() * 1}\n")
 
+    # either converts a pyformlang automaton or takes prebuilt parts:
+    # index mappings plus, for every symbol, arrays of source and target
+    # indices; matrices are built from coordinates, never densely
     def __init__(
         self,
-        fa: NondeterministicFiniteAutomaton,
+        fa: NondeterministicFiniteAutomaton | None = None,
         index_mapping: (tuple[dict[State, int], dict[int, State]] | None) = None,
+        edges: dict[Symbol, tuple[np.ndarray, np.ndarray]] | None = None,
+        start_states: set[State] | None = None,
+        final_states: set[State] | None = None,
+        workers: int | None = None,
     ):
-        self.states = fa.states
-        self.labels = fa.symbols
+        if fa is not None:
+            self.states = fa.states
+            self.labels = fa.symbols
 
-        # for DFA: casting it to NFA
-        if not (isinstance(fa.start_states, set)):
-            self.start_states = {fa.start_states}
-        else:
-            self.start_states = fa.start_states
-        if not (isinstance(fa.final_states, set)):
-            self.final_states = {fa.final_states}
+            # for DFA: casting it to NFA
+            if not (isinstance(fa.start_states, set)):
+                self.start_states = {fa.start_states}
+            else:
+                self.start_states = fa.start_states
+            if not (isinstance(fa.final_states, set)):
+                self.final_states = {fa.final_states}
+            else:
+                self.final_states = fa.final_states
         else:
-            self.final_states = fa.final_states
+            if index_mapping is None or edges is None:
+                raise ValueError("either fa or index_mapping and edges are required")
+            self.states = set(index_mapping[0])
+            self.labels = set(edges)
+            self.start_states = set(start_states or set())
+            self.final_states = set(final_states or set())
 
         if index_mapping is None:
             enum_states = list(enumerate(self.states))
@@ -45,88 +77,281 @@ class AdjacencyMatrixFA:
         else:
             self.index_of_state, self.state_of_index = index_mapping
 
-        # make a dictionary with double array to cast to csr_matrix later
-        boolean_dec_dict = dict()
-        for symbol in fa.symbols:
-            adj_arr = [
-                [False for _ in range(len(self.states))]
-                for _ in range(len(self.states))
-            ]
-            boolean_dec_dict.update({symbol: adj_arr})
-
-        # iterate over "start" states, for every one of them iterate over symbols,
-        # for every symbol iterate over "final" states and put 1 into corresponding place
-        # in its symbol's array
-        trans_func: dict = fa.to_dict()
-        for fst_state in self.states:
-            trans: dict = trans_func.get(fst_state)
-            if trans is None:
-                continue
-            for symbol in trans:
-                snd_states = trans.get(symbol)
+        if edges is None:
+            edges = self._edges_of_fa(fa)
+        states_number = len(self.states)
+
+        def build(symbol: Symbol) -> csr_matrix:
+            sources, targets = edges.get(symbol, ([], []))
+            return edges_to_bool_matrix(
+                states_number,
+                np.asarray(sources, dtype=np.int64),
+                np.asarray(targets, dtype=np.int64),
+            )
+
+        self.boolean_decompress = map_labels(build, self.labels, workers)
+
+    # coordinates of all transitions of the automaton, grouped by symbol
+    def _edges_of_fa(
+        self, fa: NondeterministicFiniteAutomaton
+    ) -> dict[Symbol, tuple[list[int], list[int]]]:
+        edges = {symbol: ([], []) for symbol in fa.symbols}
+        index_of_state = self.index_of_state
+        for fst_state, trans in fa.to_dict().items():
+            fst_index = index_of_state.get(fst_state)
+            for symbol, snd_states in trans.items():
                 if not isinstance(snd_states, set):
                     snd_states = {snd_states}
-                cur_arr = boolean_dec_dict.get(symbol)
+                sources, targets = edges[symbol]
                 for snd_state in snd_states:
-                    cur_arr[self.index_of_state.get(fst_state)][
-                        self.index_of_state.get(snd_state)
-                    ] = True
-                    boolean_dec_dict.update({symbol: cur_arr})
-
-        self.boolean_decompress = dict()
-        for symbol in boolean_dec_dict:
-            arr = boolean_dec_dict.get(symbol)
-            mat = csr_matrix(arr)
-            self.boolean_decompress.update({symbol: mat})
-
-    def get_trans_closure(self) -> csr_matrix:
-        E = identity(len(self.states), format="csr", dtype="bool")
-        sum_m = E
-        for symbol in self.boolean_decompress:
-            mat = self.boolean_decompress.get(symbol)
-            sum_m += mat
-
-        trans_closure = sum_m.copy()
-        non_zero_elem = 0
-        for _ in range(1, len(self.states)):
-            trans_closure = trans_closure @ sum_m
-            if trans_closure.count_nonzero() == non_zero_elem:
-                break
-            else:
-                non_zero_elem = trans_closure.count_nonzero()
+                    sources.append(fst_index)
+                    targets.append(index_of_state.get(snd_state))
+        return edges
+
+    # builds the automaton straight from its parts, without a pyformlang
+    # automaton in between; states[i] is the state of the i-th row/column
+    @classmethod
+    def from_matrices(
+        cls,
+        states: list[Any],
+        start_states: set[Any],
+        final_states: set[Any],
+        bool_dec: dict[Any, csr_matrix],
+    ) -> "AdjacencyMatrixFA":
+        adj = cls.__new__(cls)
+        adj.states = set(states)
+        adj.index_of_state = {state: index for index, state in enumerate(states)}
+        adj.state_of_index = dict(enumerate(states))
+        adj.start_states = set(start_states)
+        adj.final_states = set(final_states)
+        adj.labels = set(bool_dec)
+        adj.boolean_decompress = bool_dec
+        return adj
+
+    # one-step matrix of the automaton, reflexive: I + sum of all symbols
+    def _step_matrix(self, workers: int | None = None) -> csr_matrix:
+        backend = get_backend("csr")
+        for mat in self.boolean_decompress.values():
+            backend = backend_of(mat)
+            break
+        matrices = [backend.identity(len(self.states))]
+        matrices.extend(self.boolean_decompress.values())
+        return parallel_sum(matrices, workers)
+
+    def get_trans_closure_with_stats(
+        self,
+        mode: str = "squaring",
+        policy: DensityPolicy | None = None,
+        workers: int | None = None,
+    ) -> tuple[csr_matrix, "ClosureStats"]:
+        return transitive_closure(self._step_matrix(workers), mode, policy)
+
+    def get_trans_closure(
+        self,
+        mode: str = "squaring",
+        policy: DensityPolicy | None = None,
+        workers: int | None = None,
+    ) -> csr_matrix:
+        trans_closure, _ = self.get_trans_closure_with_stats(mode, policy, workers)
         return trans_closure
 
-    def is_empty(self) -> bool:
-        tc = self.get_trans_closure()
-        for start_st in self.start_states:
-            for final_st in self.final_states:
-                if tc[
-                    self.index_of_state.get(start_st),
-                    self.index_of_state.get(final_st),
-                ]:
-                    # language is non-empty, ergo false
-                    return False
+    # closure kept on disk in tiles, memory_budget is in bytes
+    def get_blocked_trans_closure(
+        self,
+        memory_budget: int,
+        directory: str | None = None,
+        workers: int | None = None,
+    ) -> TiledMatrix:
+        step = self._step_matrix(workers)
+        return blocked_transitive_closure(step, memory_budget, directory)
+
+    # BFS from the start states that stops at the first final state;
+    # all_pairs checks the full transitive closure instead
+    def is_empty(self, all_pairs: bool = False) -> bool:
+        if all_pairs:
+            return self._is_empty_by_closure()
+        final = self.final_mask()
+        front = self.start_indices()
+        if final[front].any():
+            return False
+        step = csr_matrix((len(self.states), len(self.states)), dtype=bool)
+        for mat in self.boolean_decompress.values():
+            step = step + to_csr(mat)
+        visited = np.zeros(len(self.states), dtype=bool)
+        visited[front] = True
+        while len(front) > 0:
+            reached = np.unique(_row_indices(step, front))
+            front = reached[~visited[reached]]
+            if final[front].any():
+                # language is non-empty, ergo false
+                return False
+            visited[front] = True
         return True
 
+    def _is_empty_by_closure(self) -> bool:
+        tc = to_csr(self.get_trans_closure())
+        paths = tc[self.start_indices()][:, self.final_indices()]
+        # language is non-empty if a final state is reachable from a start one
+        return paths.count_nonzero() == 0
+
+    # states in the order of their indices
+    def ordered_states(self) -> list[State]:
+        return [self.state_of_index[i] for i in range(len(self.states))]
+
+    def start_indices(self) -> np.ndarray:
+        return np.array(
+            sorted({self.index_of_state.get(st) for st in self.start_states}),
+            dtype=np.int64,
+        )
+
+    def final_indices(self) -> np.ndarray:
+        return np.array(
+            sorted({self.index_of_state.get(st) for st in self.final_states}),
+            dtype=np.int64,
+        )
+
+    def start_mask(self) -> np.ndarray:
+        mask = np.zeros(len(self.states), dtype=bool)
+        mask[self.start_indices()] = True
+        return mask
+
+    def final_mask(self) -> np.ndarray:
+        mask = np.zeros(len(self.states), dtype=bool)
+        mask[self.final_indices()] = True
+        return mask
+
+    # the set of current states is a vector of indices, every symbol
+    # moves it along the rows of the symbol's matrix
     def accepts(self, word: Iterable[Symbol]) -> bool:
-        current_states = self.start_states
-        next_states = set()
+        current = self.start_indices()
         for symbol in word:
             mat = self.boolean_decompress.get(symbol)
             if mat is None:
                 return False
-            for fst_state in current_states:
-                for snd_state in self.states:
-                    if mat[
-                        self.index_of_state.get(fst_state),
-                        self.index_of_state.get(snd_state),
-                    ]:
-                        next_states.add(snd_state)
-            current_states = next_states.copy()
-        if current_states.intersection(self.final_states):
-            return True
+            current = np.unique(_row_indices(to_csr(mat), current))
+            if len(current) == 0:
+                return False
+        return bool(np.isin(current, self.final_indices()).any())
+
+    # checks many words at once: the words are put into a trie and its
+    # levels are walked breadth-first, so a common prefix is read only once
+    # and all trie edges of a level with the same symbol take one product
+    def accepts_words(self, words: Iterable[Iterable[Symbol]]) -> list[bool]:
+        children = [dict()]
+        ends = [[]]
+        words_number = 0
+        for word in words:
+            node = 0
+            for symbol in word:
+                child = children[node].get(symbol)
+                if child is None:
+                    child = len(children)
+                    children[node][symbol] = child
+                    children.append(dict())
+                    ends.append([])
+                node = child
+            ends[node].append(words_number)
+            words_number += 1
+
+        result = [False] * words_number
+        states_number = len(self.states)
+        final = self.final_indices()
+        start = self.start_indices()
+        # row i holds the states reached by the i-th node of the level
+        reached = csr_matrix(
+            (np.ones(len(start), dtype=bool), (np.zeros(len(start), dtype=int), start)),
+            shape=(1, states_number),
+            dtype=bool,
+        )
+        level = [0]
+        while level:
+            accepted = np.asarray(reached[:, final].sum(axis=1)).ravel() > 0
+            by_symbol = dict()
+            for row, node in enumerate(level):
+                for word_index in ends[node]:
+                    result[word_index] = bool(accepted[row])
+                for symbol, child in children[node].items():
+                    rows, kids = by_symbol.setdefault(symbol, ([], []))
+                    rows.append(row)
+                    kids.append(child)
+
+            level, blocks = [], []
+            for symbol, (rows, kids) in by_symbol.items():
+                mat = self.boolean_decompress.get(symbol)
+                if mat is None:
+                    blocks.append(csr_matrix((len(rows), states_number), dtype=bool))
+                else:
+                    blocks.append(reached[rows] @ to_csr(mat))
+                level.extend(kids)
+            if blocks:
+                reached = vstack(blocks, format="csr")
+        return result
+
+
+CLOSURE_MODES = ("squaring", "semi_naive")
+
+
+@dataclass
+class ClosureStats:
+    mode: str
+    iterations: int
+    # nnz of the closure after every iteration, starting with the step matrix
+    nnz: list[int]
+
+
+# reflexive-transitive closure of a reflexive step matrix:
+# "squaring" doubles the covered path length every round (log n rounds),
+# "semi_naive" extends only the newly found pairs by one step per round;
+# the policy, if any, picks the representation of the closure every round
+def transitive_closure(
+    step: Any, mode: str = "squaring", policy: DensityPolicy | None = None
+) -> tuple[Any, ClosureStats]:
+    if mode not in CLOSURE_MODES:
+        raise ValueError(f"unknown closure mode: {mode}")
+    adapt = policy.adapt if policy is not None else lambda mat: mat
+    closure = adapt(step)
+    stats = ClosureStats(mode, 0, [nnz(closure)])
+    if mode == "squaring":
+        while True:
+            squared = adapt(matmul(closure, closure))
+            stats.iterations += 1
+            stats.nnz.append(nnz(squared))
+            if stats.nnz[-1] == stats.nnz[-2]:
+                return squared, stats
+            closure = squared
+    # a bit-packed delta meets a sparse step through its transpose, which
+    # is taken once, so the step is not packed into bits every round
+    step_t = None
+    delta = closure
+    while nnz(delta) > 0:
+        if isinstance(delta, BitMatrix) and issparse(step):
+            if step_t is None:
+                step_t = to_csr(step).T.tocsr()
+            product = delta.matmul_transposed(step_t)
         else:
-            return False
+            product = matmul(delta, step)
+        # pairs reachable by one more step that are not known yet
+        delta = adapt(product > closure)
+        closure = adapt(closure + delta)
+        stats.iterations += 1
+        stats.nnz.append(nnz(closure))
+    return closure, stats
+
+
+# only the given rows of the reflexive-transitive closure: the states
+# reachable from each of them, found semi-naively
+def closure_rows(step: Any, rows: np.ndarray) -> csr_matrix:
+    step = to_csr(step)
+    reached = csr_matrix(
+        (np.ones(len(rows), dtype=bool), (np.arange(len(rows)), rows)),
+        shape=(len(rows), step.shape[1]),
+        dtype=bool,
+    )
+    delta = reached
+    while delta.nnz > 0:
+        delta = (delta @ step) > reached
+        reached = reached + delta
+    return reached
 
 
 def build_AdjMatrixFA_with_artefacts(
@@ -137,82 +362,745 @@ def build_AdjMatrixFA_with_artefacts(
     state_of_index: dict[int, State],
     bool_dec: dict[Symbol, csr_matrix],
 ) -> AdjacencyMatrixFA:
-    nfa = NondeterministicFiniteAutomaton(
-        states=states, start_state=start_states, final_states=final_states
-    )
+    edges = dict()
     for symbol in bool_dec:
-        mat = bool_dec.get(symbol).toarray()
-        for fst_state in states:
-            for snd_state in states:
-                if mat[index_of_state.get(fst_state), index_of_state.get(snd_state)]:
-                    nfa.add_transition(fst_state, symbol, snd_state)
-    mat = AdjacencyMatrixFA(nfa, index_mapping=(index_of_state, state_of_index))
+        coo = to_csr(bool_dec.get(symbol)).tocoo()
+        edges.update({symbol: (coo.row, coo.col)})
+    mat = AdjacencyMatrixFA(
+        index_mapping=(index_of_state, state_of_index),
+        edges=edges,
+        start_states=start_states,
+        final_states=final_states,
+    )
     return mat
 
 
+# (fst, snd) of a product state State((fst, snd))
+def _state_pair(state: Any) -> tuple[Any, Any] | None:
+    value = state.value if isinstance(state, State) else None
+    if isinstance(value, tuple) and len(value) == 2:
+        return value
+    return None
+
+
+# set of the pairs State((fst, snd)) of two sets of states, never listed
+# unless iterated over
+class _PairStates(AbstractSet):
+    def __init__(self, fst_states: AbstractSet[Any], snd_states: AbstractSet[Any]):
+        self.fst_states = fst_states
+        self.snd_states = snd_states
+
+    @classmethod
+    def _from_iterable(cls, states: Iterable[Any]) -> set[Any]:
+        return set(states)
+
+    def __contains__(self, state: Any) -> bool:
+        pair = _state_pair(state)
+        return (
+            pair is not None
+            and pair[0] in self.fst_states
+            and pair[1] in self.snd_states
+        )
+
+    def __len__(self) -> int:
+        return len(self.fst_states) * len(self.snd_states)
+
+    def __iter__(self) -> Iterator[State]:
+        for fst in self.fst_states:
+            for snd in self.snd_states:
+                yield State((fst, snd))
+
+
+# index_of_state of a product: State((fst, snd)) has the index
+# fst * |Q2| + snd, as in the kron blocks
+class _ProductIndex(Mapping):
+    def __init__(self, automaton1: AdjacencyMatrixFA, automaton2: AdjacencyMatrixFA):
+        self.automaton1 = automaton1
+        self.automaton2 = automaton2
+
+    def __getitem__(self, state: Any) -> int:
+        pair = _state_pair(state)
+        if pair is None:
+            raise KeyError(state)
+        fst = self.automaton1.index_of_state[pair[0]]
+        snd = self.automaton2.index_of_state[pair[1]]
+        return fst * len(self.automaton2.states) + snd
+
+    def __len__(self) -> int:
+        return len(self.automaton1.states) * len(self.automaton2.states)
+
+    def __iter__(self) -> Iterator[State]:
+        return iter(_PairStates(self.automaton1.states, self.automaton2.states))
+
+
+# state_of_index of a product, a state is built only when looked up
+class _ProductStateOf(Mapping):
+    def __init__(self, automaton1: AdjacencyMatrixFA, automaton2: AdjacencyMatrixFA):
+        self.automaton1 = automaton1
+        self.automaton2 = automaton2
+
+    def __getitem__(self, index: int) -> State:
+        if not isinstance(index, (int, np.integer)) or not 0 <= index < len(self):
+            raise KeyError(index)
+        fst, snd = divmod(int(index), len(self.automaton2.states))
+        return State(
+            (
+                self.automaton1.state_of_index[fst],
+                self.automaton2.state_of_index[snd],
+            )
+        )
+
+    def __len__(self) -> int:
+        return len(self.automaton1.states) * len(self.automaton2.states)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(len(self)))
+
+
+# intersection whose states stay implicit: product state indices are
+# computed from the indices of the factors, and a State((fst, snd)) is
+# only made for the states someone asks for
+class ProductFA(AdjacencyMatrixFA):
+    automaton1: AdjacencyMatrixFA
+    automaton2: AdjacencyMatrixFA
+
+    def __init__(
+        self,
+        automaton1: AdjacencyMatrixFA,
+        automaton2: AdjacencyMatrixFA,
+        bool_dec: dict[Symbol, csr_matrix],
+    ):
+        self.automaton1 = automaton1
+        self.automaton2 = automaton2
+        self.states = _PairStates(automaton1.states, automaton2.states)
+        self.index_of_state = _ProductIndex(automaton1, automaton2)
+        self.state_of_index = _ProductStateOf(automaton1, automaton2)
+        self.start_states = _PairStates(
+            automaton1.start_states, automaton2.start_states
+        )
+        self.final_states = _PairStates(
+            automaton1.final_states, automaton2.final_states
+        )
+        self.labels = set(bool_dec)
+        self.boolean_decompress = bool_dec
+
+    def _pair_indices(self, fst: np.ndarray, snd: np.ndarray) -> np.ndarray:
+        # both are sorted, so the row-major pairs are sorted too
+        return (fst[:, None] * len(self.automaton2.states) + snd[None, :]).ravel()
+
+    def start_indices(self) -> np.ndarray:
+        return self._pair_indices(
+            self.automaton1.start_indices(), self.automaton2.start_indices()
+        )
+
+    def final_indices(self) -> np.ndarray:
+        return self._pair_indices(
+            self.automaton1.final_indices(), self.automaton2.final_indices()
+        )
+
+
 # NB: assume that both FA have the same alphabet (from lecture)
 def intersect_automata(
-    automaton1: AdjacencyMatrixFA, automaton2: AdjacencyMatrixFA
+    automaton1: AdjacencyMatrixFA,
+    automaton2: AdjacencyMatrixFA,
+    workers: int | None = None,
 ) -> AdjacencyMatrixFA:
-    new_states = set()
-    aut1_idx = automaton1.index_of_state
-    aut2_idx = automaton2.index_of_state
-    intersection_idxes = dict()
-    intersection_states_of_idx = dict()
-
-    for fst in automaton1.states:
-        for snd in automaton2.states:
-            intersection_idx = aut1_idx.get(fst) * len(
-                automaton2.states
-            ) + aut2_idx.get(snd)
-            new_states.add(State((fst, snd)))
-            intersection_idxes.update({State((fst, snd)): intersection_idx})
-            intersection_states_of_idx.update({intersection_idx: State((fst, snd))})
-
-    new_start_states = set()
-    for fst in automaton1.start_states:
-        for snd in automaton2.start_states:
-            new_start_states.add(State((fst, snd)))
-
-    new_final_states = set()
-    for fst in automaton1.final_states:
-        for snd in automaton2.final_states:
-            new_final_states.add(State((fst, snd)))
-
     shared_labels = automaton1.labels.intersection(automaton2.labels)
-    new_bool_dec = dict()
-    for symbol in shared_labels:
+
+    def intersect_label(symbol: Symbol) -> csr_matrix:
         fst_bool_dec = automaton1.boolean_decompress.get(symbol)
         snd_bool_dec = automaton2.boolean_decompress.get(symbol)
-        intersection = kron(fst_bool_dec, snd_bool_dec, format="csr")
-        new_bool_dec.update({symbol: intersection})
+        return backend_of(fst_bool_dec).kron(fst_bool_dec, snd_bool_dec)
+
+    new_bool_dec = map_labels(intersect_label, shared_labels, workers)
+    return ProductFA(automaton1, automaton2, new_bool_dec)
+
+
+# front of k searches run at once, stacked in blocks of block_len rows:
+# the b-th search starts in the cells (rows[b, i], cols[b, i]) of its
+# block; rows and cols are broadcast against each other, so
+# (sources[:, None], starts[None, :]) starts the b-th search from every
+# (sources[b], start) cell; built from the coordinates only
+def build_front(
+    block_len: int, width: int, rows: np.ndarray, cols: np.ndarray
+) -> csr_matrix:
+    rows, cols = np.broadcast_arrays(
+        np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+    )
+    if rows.ndim != 2:
+        raise ValueError("rows and cols must broadcast to (searches, cells)")
+    blocks_number = rows.shape[0]
+    offsets = np.arange(blocks_number, dtype=np.int64)[:, None] * block_len
+    return csr_matrix(
+        (np.ones(rows.size, dtype=bool), ((rows + offsets).ravel(), cols.ravel())),
+        shape=(blocks_number * block_len, width),
+        dtype=bool,
+    )
+
+
+# intersection that is never materialised: a set of product states is an
+# |Q1| x |Q2| matrix X (row-major, like the kron blocks), and one step by
+# a symbol is A^T X B for the symbol's matrices A and B of the factors;
+# k sets at once are k such matrices stacked vertically
+class LazyKroneckerFA:
+    automaton1: AdjacencyMatrixFA
+    automaton2: AdjacencyMatrixFA
+    labels: set[Symbol]
+    workers: int | None
+
+    def __init__(
+        self,
+        automaton1: AdjacencyMatrixFA,
+        automaton2: AdjacencyMatrixFA,
+        workers: int | None = None,
+    ):
+        self.automaton1 = automaton1
+        self.automaton2 = automaton2
+        self.workers = workers
+        self.labels = automaton1.labels.intersection(automaton2.labels)
+        self._transposed1 = {
+            symbol: to_csr(automaton1.boolean_decompress[symbol]).T.tocsr()
+            for symbol in self.labels
+        }
+        self._matrices2 = {
+            symbol: to_csr(automaton2.boolean_decompress[symbol])
+            for symbol in self.labels
+        }
+        self._left_factors_cache = (None, dict())
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return len(self.automaton1.states), len(self.automaton2.states)
+
+    def materialize(self) -> AdjacencyMatrixFA:
+        return intersect_automata(self.automaton1, self.automaton2, self.workers)
 
-    return build_AdjMatrixFA_with_artefacts(
-        new_states,
-        new_start_states,
-        new_final_states,
-        intersection_idxes,
-        intersection_states_of_idx,
-        new_bool_dec,
+    # kron(identity, transposed) for every label, built once for a number
+    # of blocks and kept while fronts of that many blocks come
+    def _left_factors(self, blocks_number: int) -> dict[Symbol, csr_matrix]:
+        cached_blocks_number, left = self._left_factors_cache
+        if cached_blocks_number != blocks_number:
+            blocks_identity = identity(blocks_number, format="csr", dtype=bool)
+            left = map_labels(
+                lambda symbol: kron(
+                    blocks_identity, self._transposed1[symbol], format="csr"
+                ),
+                self.labels,
+                self.workers,
+            )
+            self._left_factors_cache = (blocks_number, left)
+        return left
+
+    def step(self, front: csr_matrix) -> csr_matrix:
+        rows1 = self.shape[0]
+        left = self._left_factors(front.shape[0] // rows1)
+
+        def step_label(symbol: Symbol) -> csr_matrix:
+            return left[symbol] @ front @ self._matrices2[symbol]
+
+        steps = map_labels(step_label, self.labels, self.workers)
+        steps = [csr_matrix(front.shape, dtype=bool)] + list(steps.values())
+        return parallel_sum(steps, self.workers)
+
+    # all product states reachable from the given sets, the sets included
+    def reachable(self, front: csr_matrix) -> csr_matrix:
+        visited = csr_matrix(front, dtype=bool)
+        front = visited
+        while front.nnz > 0:
+            front = self.step(front) > visited
+            visited = visited + front
+        return visited
+
+    def _pairs_matrix(self, fst_states: set[Any], snd_states: set[Any]) -> csr_matrix:
+        rows = [self.automaton1.index_of_state[st] for st in fst_states]
+        cols = [self.automaton2.index_of_state[st] for st in snd_states]
+        rows, cols = np.meshgrid(rows, cols, indexing="ij")
+        data = np.ones(rows.size, dtype=bool)
+        return csr_matrix(
+            (data, (rows.ravel(), cols.ravel())), shape=self.shape, dtype=bool
+        )
+
+    def is_empty(self) -> bool:
+        final = self._pairs_matrix(
+            self.automaton1.final_states, self.automaton2.final_states
+        )
+        visited = self._pairs_matrix(
+            self.automaton1.start_states, self.automaton2.start_states
+        )
+        front = visited
+        while front.nnz > 0:
+            if front.multiply(final).nnz > 0:
+                return False
+            front = self.step(front) > visited
+            visited = visited + front
+        return True
+
+
+# same conventions as task2.graph_to_nfa: empty start/final sets mean
+# "all nodes", unlabeled edges are epsilon edges; graph nodes and labels
+# are used as states and symbols as is
+def _graph_states(
+    nodes: list[Any], start_states: set[Any], final_states: set[Any]
+) -> tuple[list[Any], set[Any], set[Any]]:
+    start_states = set(start_states) if len(start_states) > 0 else set(nodes)
+    final_states = set(final_states) if len(final_states) > 0 else set(nodes)
+    known = set(nodes)
+    # like in pyformlang, start and final states are states even without edges
+    extra = (start_states | final_states) - known
+    return nodes + sorted(extra, key=str), start_states, final_states
+
+
+def edges_to_adj_matrix_fa(
+    nodes: list[Any],
+    edges_by_label: dict[Any, tuple[np.ndarray, np.ndarray]],
+    start_states: set[Any],
+    final_states: set[Any],
+    workers: int | None = None,
+) -> AdjacencyMatrixFA:
+    states, start_states, final_states = _graph_states(
+        list(nodes), start_states, final_states
+    )
+    return AdjacencyMatrixFA(
+        index_mapping=(
+            {state: index for index, state in enumerate(states)},
+            dict(enumerate(states)),
+        ),
+        edges=edges_by_label,
+        start_states=start_states,
+        final_states=final_states,
+        workers=workers,
+    )
+
+
+def graph_matrices_to_adj_matrix_fa(
+    matrices: GraphMatrices,
+    start_states: set[Any],
+    final_states: set[Any],
+    workers: int | None = None,
+) -> AdjacencyMatrixFA:
+    states, start_states, final_states = _graph_states(
+        matrices.nodes.tolist(), start_states, final_states
+    )
+
+    def convert(label: Any) -> csr_matrix:
+        mat = csr_matrix(matrices.matrices[label], dtype=bool)
+        if mat.shape != (len(states), len(states)):
+            mat = mat.copy()
+            mat.resize((len(states), len(states)))
+        return mat
+
+    bool_dec = map_labels(convert, matrices.matrices, workers)
+    return AdjacencyMatrixFA.from_matrices(states, start_states, final_states, bool_dec)
+
+
+def graph_to_adj_matrix_fa(
+    graph: MultiDiGraph,
+    start_states: set[Any],
+    final_states: set[Any],
+    workers: int | None = None,
+) -> AdjacencyMatrixFA:
+    nodes = list(graph.nodes)
+    index_of_node = {node: index for index, node in enumerate(nodes)}
+    edges_by_label = dict()
+    for fst, snd, label in graph.edges(data="label"):
+        if label is None:
+            label = EPSILON
+        sources, targets = edges_by_label.setdefault(label, ([], []))
+        sources.append(index_of_node[fst])
+        targets.append(index_of_node[snd])
+
+    edges_by_label = {
+        label: (np.array(sources, dtype=np.int64), np.array(targets, dtype=np.int64))
+        for label, (sources, targets) in edges_by_label.items()
+    }
+    return edges_to_adj_matrix_fa(
+        nodes, edges_by_label, start_states, final_states, workers
+    )
+
+
+# graph turned into label matrices once, to be queried many times: the
+# automaton of every query shares these matrices, only its start and
+# final states are its own; GraphMatrices loaded from a CSV or the graph
+# cache are taken as they are, with no networkx graph built
+class PreparedGraph:
+    graph_fa: AdjacencyMatrixFA
+    nodes: list[Any]
+
+    def __init__(self, graph: MultiDiGraph | GraphMatrices, workers: int | None = None):
+        self.graph_fa = graph_fa_for_query(graph, set(), set(), workers)
+        self.nodes = self.graph_fa.ordered_states()
+
+    def automaton(
+        self, start_nodes: set[Any], final_nodes: set[Any]
+    ) -> AdjacencyMatrixFA:
+        states, start_states, final_states = _graph_states(
+            self.nodes, start_nodes, final_nodes
+        )
+        bool_dec = self.graph_fa.boolean_decompress
+        if len(states) > len(self.nodes):
+            # start or final nodes out of the graph are isolated states
+            bool_dec = dict()
+            for label, mat in self.graph_fa.boolean_decompress.items():
+                mat = mat.copy()
+                mat.resize((len(states), len(states)))
+                bool_dec[label] = mat
+        return AdjacencyMatrixFA.from_matrices(
+            states, start_states, final_states, bool_dec
+        )
+
+
+def graph_fa_for_query(
+    graph: MultiDiGraph | GraphMatrices | PreparedGraph,
+    start_nodes: set[Any],
+    final_nodes: set[Any],
+    workers: int | None = None,
+) -> AdjacencyMatrixFA:
+    if isinstance(graph, PreparedGraph):
+        return graph.automaton(start_nodes, final_nodes)
+    if isinstance(graph, GraphMatrices):
+        return graph_matrices_to_adj_matrix_fa(graph, start_nodes, final_nodes, workers)
+    return graph_to_adj_matrix_fa(graph, start_nodes, final_nodes, workers)
+
+
+# subset construction over the matrices, given up as soon as the DFA
+# would get as many states as the automaton already has, so it never blows up
+def determinize_if_smaller(automaton: AdjacencyMatrixFA) -> AdjacencyMatrixFA:
+    states_number = len(automaton.states)
+    start = frozenset(automaton.index_of_state.get(st) for st in automaton.start_states)
+    finals = {automaton.index_of_state.get(st) for st in automaton.final_states}
+    bool_dec = {
+        symbol: to_csr(mat) for symbol, mat in automaton.boolean_decompress.items()
+    }
+
+    index_of_subset = {start: 0}
+    queue = [start]
+    coords = {symbol: ([], []) for symbol in bool_dec}
+    while queue:
+        subset = queue.pop()
+        rows = sorted(subset)
+        for symbol, mat in bool_dec.items():
+            next_subset = frozenset(mat[rows].indices.tolist())
+            if not next_subset:
+                continue
+            if next_subset not in index_of_subset:
+                if len(index_of_subset) + 1 >= states_number:
+                    return automaton
+                index_of_subset[next_subset] = len(index_of_subset)
+                queue.append(next_subset)
+            sources, targets = coords[symbol]
+            sources.append(index_of_subset[subset])
+            targets.append(index_of_subset[next_subset])
+
+    size = len(index_of_subset)
+    if size >= states_number:
+        return automaton
+    dfa_bool_dec = {
+        symbol: edges_to_bool_matrix(size, np.array(sources), np.array(targets))
+        for symbol, (sources, targets) in coords.items()
+    }
+    dfa_finals = {i for subset, i in index_of_subset.items() if subset & finals}
+    return AdjacencyMatrixFA.from_matrices(
+        list(range(size)), {0}, dfa_finals, dfa_bool_dec
+    )
+
+
+# column indices of the given rows, without scipy's slicing overhead
+def _row_indices(matrix: csr_matrix, rows: np.ndarray) -> np.ndarray:
+    starts = matrix.indptr[rows]
+    lengths = matrix.indptr[rows + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return matrix.indices[offsets + np.arange(lengths.sum())]
+
+
+def _reachable(matrix: csr_matrix, start: np.ndarray) -> np.ndarray:
+    reached = np.zeros(matrix.shape[0], dtype=bool)
+    reached[start] = True
+    front = start
+    while len(front) > 0:
+        nxt = np.unique(_row_indices(matrix, front))
+        front = nxt[~reached[nxt]]
+        reached[front] = True
+    return reached
+
+
+# Hopcroft partition refinement: block[i] is the block of the i-th state,
+# members[b] are the states of block b; -1 marks trimmed states.
+# For DFAs only the smaller half of a split block is queued (n log n);
+# for NFAs both halves are, which gives the coarsest bisimulation
+def _partition_states(
+    automaton: AdjacencyMatrixFA, trim: bool = True
+) -> tuple[np.ndarray, list[np.ndarray]]:
+    n = len(automaton.states)
+    index_of_state = automaton.index_of_state
+    start = np.array(
+        [index_of_state[st] for st in automaton.start_states], dtype=np.int64
+    )
+    final = np.array(
+        [index_of_state[st] for st in automaton.final_states], dtype=np.int64
+    )
+    mats = [to_csr(mat) for mat in automaton.boolean_decompress.values()]
+
+    useful = np.ones(n, dtype=bool)
+    if trim:
+        total = csr_matrix((n, n), dtype=bool)
+        for mat in mats:
+            total = total + mat
+        useful = _reachable(total, start) & _reachable(total.T.tocsr(), final)
+
+    is_final = np.zeros(n, dtype=bool)
+    is_final[final] = True
+    block = np.full(n, -1, dtype=np.int64)
+    members = []
+    for part in (useful & is_final, useful & ~is_final):
+        if part.any():
+            block[part] = len(members)
+            members.append(np.flatnonzero(part))
+
+    deterministic = all(np.diff(mat.indptr).max(initial=0) <= 1 for mat in mats)
+    # predecessors: row j of inverse[a] holds the states with an a-edge into j
+    inverse = [mat.T.tocsr() for mat in mats]
+    # DFAs may be partial, so both initial blocks are splitters
+    queue = [(b, a) for b in range(len(members)) for a in range(len(mats))]
+    queued = set(queue)
+
+    while queue:
+        splitter = queue.pop()
+        queued.discard(splitter)
+        b, a = splitter
+        pre = np.unique(_row_indices(inverse[a], members[b]))
+        pre = pre[block[pre] >= 0]
+        if len(pre) == 0:
+            continue
+        # group the predecessors by their block
+        pre = pre[np.argsort(block[pre], kind="stable")]
+        touched, firsts, counts = np.unique(
+            block[pre], return_index=True, return_counts=True
+        )
+        for old, first, count in zip(
+            touched.tolist(), firsts.tolist(), counts.tolist()
+        ):
+            if count == len(members[old]):
+                continue
+            inside = pre[first : first + count]
+            new = len(members)
+            members[old] = np.setdiff1d(members[old], inside, assume_unique=True)
+            members.append(inside)
+            block[inside] = new
+            for c in range(len(mats)):
+                if (old, c) in queued or not deterministic:
+                    halves = (old, new)
+                elif len(members[new]) <= len(members[old]):
+                    halves = (new,)
+                else:
+                    halves = (old,)
+                for half in halves:
+                    if (half, c) not in queued:
+                        queued.add((half, c))
+                        queue.append((half, c))
+    return block, members
+
+
+# quotient of the automaton by its coarsest stable partition; the
+# language is kept, states become block numbers (a minimal DFA for DFAs)
+def minimize_matrix_fa(
+    automaton: AdjacencyMatrixFA, trim: bool = True
+) -> AdjacencyMatrixFA:
+    block, members = _partition_states(automaton, trim)
+    size = len(members)
+    if size == 0:
+        # nothing is accepted: one state, start only if there was a start state
+        return AdjacencyMatrixFA.from_matrices(
+            [0],
+            {0} if automaton.start_states else set(),
+            set(),
+            {
+                symbol: csr_matrix((1, 1), dtype=bool)
+                for symbol in automaton.boolean_decompress
+            },
+        )
+
+    bool_dec = dict()
+    for symbol, mat in automaton.boolean_decompress.items():
+        coo = to_csr(mat).tocoo()
+        keep = (block[coo.row] >= 0) & (block[coo.col] >= 0)
+        bool_dec[symbol] = edges_to_bool_matrix(
+            size, block[coo.row[keep]], block[coo.col[keep]]
+        )
+    index_of_state = automaton.index_of_state
+    start_blocks = {int(block[index_of_state[st]]) for st in automaton.start_states}
+    final_blocks = {int(block[index_of_state[st]]) for st in automaton.final_states}
+    return AdjacencyMatrixFA.from_matrices(
+        list(range(size)),
+        start_blocks - {-1},
+        final_blocks - {-1},
+        bool_dec,
+    )
+
+
+def _shared_dfa_matrix_fa(regex: str) -> AdjacencyMatrixFA:
+    compiled = REGEX_CACHE.get(regex)
+    return compiled.artefact("dfa_matrix_fa", lambda: AdjacencyMatrixFA(compiled.dfa))
+
+
+# minimised Glushkov automaton of the regex, built without pyformlang;
+# states are integers
+def _shared_nfa_matrix_fa(regex: str, determinize: bool = True) -> AdjacencyMatrixFA:
+    compiled = REGEX_CACHE.get(regex)
+
+    def build() -> AdjacencyMatrixFA:
+        glushkov = compiled.glushkov
+        automaton = AdjacencyMatrixFA.from_matrices(
+            list(range(glushkov.states_number)),
+            {0},
+            glushkov.final_states,
+            glushkov.matrices,
+        )
+        automaton = minimize_matrix_fa(automaton)
+        if determinize:
+            automaton = minimize_matrix_fa(determinize_if_smaller(automaton))
+        return automaton
+
+    return compiled.artefact(("nfa_matrix_fa", determinize), build)
+
+
+def copy_matrix_fa(automaton: AdjacencyMatrixFA) -> AdjacencyMatrixFA:
+    return AdjacencyMatrixFA.from_matrices(
+        automaton.ordered_states(),
+        automaton.start_states,
+        automaton.final_states,
+        {label: mat.copy() for label, mat in automaton.boolean_decompress.items()},
+    )
+
+
+# the automata kept in the regex cache are shared by all queries, so
+# callers get copies they may modify
+def regex_to_matrix_fa(regex: str) -> AdjacencyMatrixFA:
+    return copy_matrix_fa(_shared_dfa_matrix_fa(regex))
+
+
+def regex_to_nfa_matrix_fa(regex: str, determinize: bool = True) -> AdjacencyMatrixFA:
+    return copy_matrix_fa(_shared_nfa_matrix_fa(regex, determinize))
+
+
+# the same automaton with its matrices in another backend
+def to_backend_matrix_fa(
+    automaton: AdjacencyMatrixFA, backend: str
+) -> AdjacencyMatrixFA:
+    states = automaton.ordered_states()
+    convert = get_backend(backend).convert
+    bool_dec = {
+        symbol: convert(mat) for symbol, mat in automaton.boolean_decompress.items()
+    }
+    return AdjacencyMatrixFA.from_matrices(
+        states, automaton.start_states, automaton.final_states, bool_dec
+    )
+
+
+# bit-packed matrices, for closures that fill in
+def to_bit_matrix_fa(automaton: AdjacencyMatrixFA) -> AdjacencyMatrixFA:
+    return to_backend_matrix_fa(automaton, "bits")
+
+
+# RPQ engines take either a regex or an already built query automaton
+def query_to_matrix_fa(query: str | AdjacencyMatrixFA) -> AdjacencyMatrixFA:
+    if isinstance(query, AdjacencyMatrixFA):
+        return query
+    # engines only read the query automaton, so the cached one is used as is
+    return _shared_nfa_matrix_fa(query)
+
+
+# reachability in the lazy product from all start pairs at once,
+# the b-th block of rows of the front belongs to the b-th start node
+def _lazy_tensor_rpq(
+    query: AdjacencyMatrixFA,
+    graph_fa: AdjacencyMatrixFA,
+    as_matrix: bool,
+    workers: int | None = None,
+) -> set[tuple[Any, Any]] | ReachabilityResult:
+    product = LazyKroneckerFA(query, graph_fa, workers)
+    query_len, graph_len = product.shape
+    query_start = query.start_indices()
+    graph_start = graph_fa.start_indices()
+    front = build_front(
+        query_len, graph_len, query_start[None, :], graph_start[:, None]
+    )
+    visited = product.reachable(front)
+    # row b * |Q| + q is the query state q reached from the b-th start node
+    return extract_answers(
+        visited,
+        node_array(graph_fa.ordered_states()),
+        np.repeat(graph_start, query_len),
+        np.arange(graph_len),
+        np.tile(query.final_mask(), len(graph_start)),
+        graph_fa.final_mask(),
+        as_matrix,
+    )
+
+
+# closure rows of the product's start states only, the answers are the
+# final-state columns of them
+def _start_restricted_rpq(
+    intersection: AdjacencyMatrixFA,
+    graph_fa: AdjacencyMatrixFA,
+    as_matrix: bool,
+    workers: int | None = None,
+) -> set[tuple[Any, Any]] | ReachabilityResult:
+    starts = intersection.start_indices()
+    reached = closure_rows(intersection._step_matrix(workers), starts)
+    # product index fst * |V| + snd, snd is the graph part
+    graph_len = len(graph_fa.states)
+    graph_part = np.arange(len(intersection.states)) % graph_len
+    return extract_answers(
+        reached,
+        node_array(graph_fa.ordered_states()),
+        starts % graph_len,
+        graph_part,
+        col_mask=intersection.final_mask(),
+        as_matrix=as_matrix,
     )
 
 
 def tensor_based_rpq(
-    regex: str, graph: MultiDiGraph, start_nodes: set[int], final_nodes: set[int]
-) -> set[tuple[int, int]]:
-    reg_graph = regex_to_dfa(regex)
-    aut1 = AdjacencyMatrixFA(reg_graph)
-    aut2 = AdjacencyMatrixFA(graph_to_nfa(graph, start_nodes, final_nodes))
-
-    intersection = intersect_automata(aut1, aut2)
-    ind_of_st = intersection.index_of_state
-    int_tc = intersection.get_trans_closure()
-    result = set()
-    for start in intersection.start_states:
-        for final in intersection.final_states:
-            if int_tc[ind_of_st.get(start), ind_of_st.get(final)]:
-                # values of intersection's states are pairs of initial aut's states
-                _, start_gr = start.value
-                _, final_gr = final.value
-                result.add((start_gr, final_gr))
-    return result
+    regex: str | AdjacencyMatrixFA,
+    graph: MultiDiGraph | GraphMatrices | PreparedGraph,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    closure_mode: str = "squaring",
+    policy: DensityPolicy | None = None,
+    lazy: bool = False,
+    from_starts: bool = False,
+    as_matrix: bool = False,
+    workers: int | None = None,
+    memory_budget: int | None = None,
+) -> set[tuple[int, int]] | ReachabilityResult:
+    aut1 = query_to_matrix_fa(regex)
+    aut2 = graph_fa_for_query(graph, start_nodes, final_nodes, workers)
+    if lazy:
+        return _lazy_tensor_rpq(aut1, aut2, as_matrix, workers)
+
+    intersection = intersect_automata(aut1, aut2, workers)
+    if from_starts:
+        return _start_restricted_rpq(intersection, aut2, as_matrix, workers)
+    graph_part = np.arange(len(intersection.states)) % len(aut2.states)
+    if memory_budget is not None:
+        # only the rows of the start states are read back from disk
+        int_tc = intersection.get_blocked_trans_closure(memory_budget, workers=workers)
+        starts = intersection.start_indices()
+        return extract_answers(
+            int_tc.rows(starts),
+            node_array(aut2.ordered_states()),
+            graph_part[starts],
+            graph_part,
+            col_mask=intersection.final_mask(),
+            as_matrix=as_matrix,
+        )
+    int_tc = intersection.get_trans_closure(closure_mode, policy, workers)
+    return extract_answers(
+        int_tc,
+        node_array(aut2.ordered_states()),
+        graph_part,
+        graph_part,
+        intersection.start_mask(),
+        intersection.final_mask(),
+        as_matrix,
+    )
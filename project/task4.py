@@ -1,88 +1,351 @@
+from functools import partial
+from typing import Any, Callable, Iterator
+
 from networkx import MultiDiGraph
-from scipy.sparse import csr_matrix, vstack
+import numpy as np
+from scipy.sparse import block_diag, csr_matrix, identity, kron, vstack
 
-from project.task3 import AdjacencyMatrixFA
-from project.task2 import regex_to_dfa, graph_to_nfa
+from project.bit_matrix import BitMatrix
+from project.matrix_backend import (
+    DensityPolicy,
+    backend_of,
+    get_backend,
+    matmul,
+    to_csr,
+)
+from project.parallel import map_labels, parallel_sum
+from project.reachability import ReachabilityResult, extract_answers, node_array
+from project.task1 import GraphMatrices
+from project.task3 import (
+    AdjacencyMatrixFA,
+    PreparedGraph,
+    build_front,
+    graph_fa_for_query,
+    query_to_matrix_fa,
+)
 
 
-def _build_front(
-    aut1_len: int, aut2_len: int, aut1_start: set[int], aut2_start: set[int]
-) -> csr_matrix:
-    fronts_by_starts = list()
+# front @ graph matrix; a bit-packed front is multiplied word by word
+# through the transposed graph matrix, so neither of them is unpacked
+def _graph_step(front: Any, graph_mat: Any, graph_t: Callable[[], Any]) -> Any:
+    if isinstance(front, BitMatrix):
+        return front.matmul_transposed(graph_t())
+    return matmul(front, graph_mat)
 
-    for i in sorted(aut1_start):
-        front_arr = [[False for _ in range(aut2_len)] for _ in range(aut1_len)]
-        for j in aut2_start:
-            front_arr[i][j] = True
-        fronts_by_starts.append(csr_matrix(front_arr))
-    front = vstack(fronts_by_starts, format="csr", dtype=bool)
-    return front
 
+def _nonempty_rows(mat: Any) -> np.ndarray:
+    if isinstance(mat, BitMatrix):
+        return mat.words.any(axis=1)
+    if isinstance(mat, np.ndarray):
+        return np.asarray(mat).any(axis=1)
+    return to_csr(mat).getnnz(axis=1) > 0
 
-def ms_bfs_based_rpq(
-    regex: str, graph: MultiDiGraph, start_nodes: set[int], final_nodes: set[int]
-) -> set[tuple[int, int]]:
-    aut1 = graph_to_nfa(graph, start_nodes, final_nodes)
-    aut2 = regex_to_dfa(regex)
-    adj1 = AdjacencyMatrixFA(aut1)
-    adj2 = AdjacencyMatrixFA(aut2)
-
-    aut1_start_st_ind = set()
-    for start_state in aut1.start_states:
-        aut1_start_st_ind.add(adj1.index_of_state.get(start_state))
-    aut2_start_st_ind = set()
-    for start_state in aut2.start_states:
-        aut2_start_st_ind.add(adj2.index_of_state.get(start_state))
-    front = _build_front(
-        len(aut1.states),
-        len(aut2.states),
-        sorted(list(aut1_start_st_ind)),
-        aut2_start_st_ind,
+
+def _take_rows(mat: Any, rows: np.ndarray) -> Any:
+    if isinstance(mat, BitMatrix):
+        return BitMatrix((len(rows), mat.shape[1]), mat.words[rows])
+    return mat[rows]
+
+
+# blocks of the searches of several queries run as one front: the i-th
+# query gets a block of |Q_i| rows for every start node in starts[i],
+# blocks go query by query; returns the query, the start node and the
+# length of every block
+def _blocks_layout(
+    queries: list[AdjacencyMatrixFA], starts: list[np.ndarray]
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    counts = [len(query_starts) for query_starts in starts]
+    query_of_block = np.repeat(np.arange(len(queries), dtype=np.int64), counts)
+    start_of_block = np.concatenate([np.zeros(0, dtype=np.int64)] + list(starts))
+    sizes = np.array([len(query.states) for query in queries], dtype=np.int64)
+    return query_of_block, start_of_block, sizes[query_of_block]
+
+
+# P of every label for the blocks of the front: the block diagonal of
+# the transposed query matrices, one per block, block by block
+def _query_steps(
+    queries: list[AdjacencyMatrixFA],
+    query_of_block: np.ndarray,
+    labels: set[Any],
+    workers: int | None,
+) -> dict[Any, csr_matrix]:
+    counts = np.bincount(query_of_block, minlength=len(queries))
+
+    def query_step(label: Any) -> csr_matrix:
+        parts = [
+            kron(
+                identity(counts[i], format="csr", dtype=bool),
+                (
+                    to_csr(query.boolean_decompress[label]).T.tocsr()
+                    if label in query.boolean_decompress
+                    else csr_matrix((len(query.states), len(query.states)), dtype=bool)
+                ),
+                format="csr",
+            )
+            for i, query in enumerate(queries)
+            if counts[i] > 0 and len(query.states) > 0
+        ]
+        step = (
+            block_diag(parts, format="csr", dtype=bool)
+            if parts
+            else csr_matrix((0, 0), dtype=bool)
+        )
+        # kron and block_diag may keep stored False entries
+        step.eliminate_zeros()
+        return step
+
+    return map_labels(query_step, labels, workers)
+
+
+# multi-source BFS in the product of the queries and the graph: cell
+# (row, v) of a block of the i-th query is the product state (q, v) for
+# the q-th row of the block, so a step by a label is P @ front @ A for the
+# graph matrix A and the block diagonal P of the transposed query matrices
+# of the blocks: a row remap inside the blocks (a permutation for a DFA)
+# and one product with the graph matrix. Yields the numbers of the blocks
+# whose search is over together with their visited cells, and drops these
+# blocks from the search
+def _ms_bfs(
+    graph_fa: AdjacencyMatrixFA,
+    queries: list[AdjacencyMatrixFA],
+    starts: list[np.ndarray],
+    bit_front: bool,
+    policy: DensityPolicy | None,
+    workers: int | None,
+) -> Iterator[tuple[np.ndarray, Any]]:
+    query_of_block, _, block_len = _blocks_layout(queries, starts)
+    graph_len = len(graph_fa.states)
+    fronts = [
+        build_front(
+            len(query.states),
+            graph_len,
+            query.start_indices()[None, :],
+            query_starts[:, None],
+        )
+        for query, query_starts in zip(queries, starts)
+    ]
+    front = vstack(
+        [csr_matrix((0, graph_len), dtype=bool)] + fronts, format="csr", dtype=bool
     )
+    # dense fronts are kept bit-packed
+    if bit_front:
+        front = get_backend("bits").convert(front)
+    adapt = policy.adapt if policy is not None else lambda mat: mat
+    front = adapt(front)
+
+    shared_labels = set()
+    for query in queries:
+        shared_labels |= graph_fa.labels.intersection(query.labels)
 
-    bool_dec_transposed = dict()
-    for symbol in adj1.boolean_decompress:
-        bool_dec_transposed.update(
-            {symbol: adj1.boolean_decompress.get(symbol).transpose()}
+    steps = _query_steps(queries, query_of_block, shared_labels, workers)
+
+    # graph matrices are transposed once, when a bit-packed front first
+    # meets them; every label is transposed by the one worker stepping by it
+    transposed_graph = dict()
+
+    def graph_t(label: Any) -> csr_matrix:
+        if label not in transposed_graph:
+            mat = to_csr(graph_fa.boolean_decompress[label])
+            transposed_graph[label] = mat.T.tocsr()
+        return transposed_graph[label]
+
+    # the front of every label is computed concurrently
+    def step_label(label: Any) -> Any:
+        return _graph_step(
+            matmul(steps[label], front),
+            graph_fa.boolean_decompress[label],
+            partial(graph_t, label),
         )
 
+    # a step matrix is block diagonal, so the rows and columns of the
+    # blocks that are still searched make the step matrix of these blocks
+    def keep_rows(label: Any, rows: np.ndarray) -> csr_matrix:
+        return steps[label][rows][:, rows]
+
+    # only the newly reached cells are expanded, so every product state
+    # is stepped from once; a search is over when its block of the front
+    # is empty
+    blocks = np.arange(len(query_of_block))
     visited = front
-    shared_labels = adj1.labels.intersection(adj2.labels)
-    finished = False
-    while not finished:
-        current_front_sum = csr_matrix(
-            (len(aut1.states) * len(start_nodes), len(aut2.states)), dtype=bool
+    while len(blocks) > 0:
+        zeros = backend_of(front).zeros(front.shape)
+        label_fronts = map_labels(step_label, shared_labels, workers)
+        reached = parallel_sum([zeros] + list(label_fronts.values()), workers)
+        front = adapt(reached > visited)
+        visited = adapt(visited + front)
+
+        block_of_row = np.repeat(np.arange(len(blocks)), block_len[blocks])
+        active = np.zeros(len(blocks), dtype=bool)
+        active[block_of_row[_nonempty_rows(front)]] = True
+        if active.all():
+            continue
+        done_rows = np.flatnonzero(~active[block_of_row])
+        active_rows = np.flatnonzero(active[block_of_row])
+        yield blocks[~active], _take_rows(visited, done_rows)
+        blocks = blocks[active]
+        front = _take_rows(front, active_rows)
+        visited = _take_rows(visited, active_rows)
+        steps = map_labels(partial(keep_rows, rows=active_rows), shared_labels, workers)
+
+
+# answers of every query out of the finished blocks of _ms_bfs; the
+# graph_final[i] mask selects the final graph nodes of the i-th query
+def _ms_bfs_answers(
+    graph_fa: AdjacencyMatrixFA,
+    queries: list[AdjacencyMatrixFA],
+    starts: list[np.ndarray],
+    graph_final: list[np.ndarray],
+    bit_front: bool,
+    policy: DensityPolicy | None,
+    as_matrix: bool,
+    workers: int | None,
+) -> list[set[tuple[Any, Any]] | ReachabilityResult]:
+    query_of_block, start_of_block, block_len = _blocks_layout(queries, starts)
+    done_blocks, done_visited = [np.zeros(0, dtype=np.int64)], []
+    searches = _ms_bfs(graph_fa, queries, starts, bit_front, policy, workers)
+    for blocks, visited in searches:
+        done_blocks.append(blocks)
+        done_visited.append(to_csr(visited))
+    blocks = np.concatenate(done_blocks)
+    graph_len = len(graph_fa.states)
+    visited = vstack(
+        [csr_matrix((0, graph_len), dtype=bool)] + done_visited,
+        format="csr",
+        dtype=bool,
+    )
+
+    # block, query and query state of every row of visited
+    lengths = block_len[blocks]
+    block_of_row = np.repeat(blocks, lengths)
+    first_rows = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    state_of_row = np.arange(len(block_of_row)) - first_rows
+    query_of_row = query_of_block[block_of_row]
+
+    nodes = node_array(graph_fa.ordered_states())
+    answers = []
+    for i, query in enumerate(queries):
+        rows = np.flatnonzero(query_of_row == i)
+        # an answer is a final graph node reached in a final query state
+        answers.append(
+            extract_answers(
+                visited[rows],
+                nodes,
+                start_of_block[block_of_row[rows]],
+                np.arange(graph_len),
+                query.final_mask()[state_of_row[rows]],
+                graph_final[i],
+                as_matrix,
+            )
         )
-        for label in shared_labels:
-            aut1_mat = bool_dec_transposed.get(label)
-            aut2_mat = adj2.boolean_decompress.get(label)
-            blocks = []
-            for b_num in range(len(start_nodes)):
-                cur_b = front[
-                    b_num * len(aut1.states) : (b_num + 1) * len(aut1.states), :
-                ]
-                new_block = aut1_mat @ cur_b
-                blocks.append(new_block)
-            symbol_front = vstack(blocks, format="csr")
-            result = symbol_front @ aut2_mat
-            current_front_sum += result
-        front = current_front_sum
-        finished = not (visited < current_front_sum).toarray().any()
-        visited += front
-
-    result = set()
-    start_list = sorted(list(start_nodes))
-    for start_num in range(len(start_nodes)):
-        cur_start = start_list[start_num]
-        cur_visited = visited[
-            start_num * len(aut1.states) : (start_num + 1) * len(aut1.states), :
-        ]
-        for i in adj1.states:
-            for j in adj2.states:
-                if (
-                    cur_visited[adj1.index_of_state.get(i), adj2.index_of_state.get(j)]
-                    and (i in adj1.final_states)
-                    and (j in adj2.final_states)
-                ):
-                    result.add((cur_start, i))
-    return result
+    return answers
+
+
+def ms_bfs_based_rpq(
+    regex: str | AdjacencyMatrixFA,
+    graph: MultiDiGraph | GraphMatrices | PreparedGraph,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    bit_front: bool = False,
+    policy: DensityPolicy | None = None,
+    as_matrix: bool = False,
+    workers: int | None = None,
+) -> set[tuple[int, int]] | ReachabilityResult:
+    adj1 = graph_fa_for_query(graph, start_nodes, final_nodes, workers)
+    adj2 = query_to_matrix_fa(regex)
+    (answers,) = _ms_bfs_answers(
+        adj1,
+        [adj2],
+        [adj1.start_indices()],
+        [adj1.final_mask()],
+        bit_front,
+        policy,
+        as_matrix,
+        workers,
+    )
+    return answers
+
+
+# answers of ms_bfs_based_rpq grouped by start node: (start, final nodes
+# reachable from it) is yielded as soon as the search from this start is
+# over, the searches from the other starts going on
+def ms_bfs_rpq_by_source(
+    regex: str | AdjacencyMatrixFA,
+    graph: MultiDiGraph | GraphMatrices | PreparedGraph,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    bit_front: bool = False,
+    policy: DensityPolicy | None = None,
+    workers: int | None = None,
+) -> Iterator[tuple[Any, set[Any]]]:
+    adj1 = graph_fa_for_query(graph, start_nodes, final_nodes, workers)
+    adj2 = query_to_matrix_fa(regex)
+    starts = adj1.start_indices()
+    nodes = node_array(adj1.ordered_states())
+    # plain Python nodes, whatever the dtype of the node array
+    start_of_block = nodes[starts].tolist()
+    query_len = len(adj2.states)
+    final_query = adj2.final_indices()
+    final_graph = adj1.final_mask()
+
+    searches = _ms_bfs(adj1, [adj2], [starts], bit_front, policy, workers)
+    for blocks, visited in searches:
+        visited = to_csr(visited)
+        for number, block in enumerate(blocks):
+            rows = visited[number * query_len + final_query]
+            reached = np.unique(rows.indices[final_graph[rows.indices]])
+            yield start_of_block[block], set(nodes[reached].tolist())
+
+
+# many queries (regex, start nodes, final nodes) against one prepared
+# graph; with fuse the searches of all queries make one front, so every
+# step is one product with each label matrix of the graph for them all.
+# Queries with start or final nodes out of the graph are run on their own
+def batch_rpq(
+    graph: MultiDiGraph | GraphMatrices | PreparedGraph,
+    queries: list[tuple[str | AdjacencyMatrixFA, set[Any], set[Any]]],
+    fuse: bool = True,
+    bit_front: bool = False,
+    policy: DensityPolicy | None = None,
+    as_matrix: bool = False,
+    workers: int | None = None,
+) -> list[set[tuple[Any, Any]] | ReachabilityResult]:
+    if not isinstance(graph, PreparedGraph):
+        graph = PreparedGraph(graph, workers)
+    graph_fa = graph.graph_fa
+    answers = [None] * len(queries)
+
+    fused, fused_queries, fused_starts, fused_finals = [], [], [], []
+    for number, (regex, start_nodes, final_nodes) in enumerate(queries):
+        known = set(start_nodes) | set(final_nodes)
+        if not fuse or not known <= graph_fa.index_of_state.keys():
+            answers[number] = ms_bfs_based_rpq(
+                regex,
+                graph,
+                start_nodes,
+                final_nodes,
+                bit_front,
+                policy,
+                as_matrix,
+                workers,
+            )
+            continue
+        query_fa = graph.automaton(start_nodes, final_nodes)
+        fused.append(number)
+        fused_queries.append(query_to_matrix_fa(regex))
+        fused_starts.append(query_fa.start_indices())
+        fused_finals.append(query_fa.final_mask())
+
+    if fused:
+        fused_answers = _ms_bfs_answers(
+            graph_fa,
+            fused_queries,
+            fused_starts,
+            fused_finals,
+            bit_front,
+            policy,
+            as_matrix,
+            workers,
+        )
+        for number, query_answers in zip(fused, fused_answers):
+            answers[number] = query_answers
+    return answers
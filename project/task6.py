@@ -1,6 +1,11 @@
 from pyformlang.cfg import Production, Variable, Terminal, CFG, Epsilon
 from networkx import DiGraph
 from collections import defaultdict
+from scipy.sparse import csr_matrix
+
+import numpy as np
+
+from project.reachability import ReachabilityResult, extract_answers, node_array
 
 
 def cfg_to_weak_normal_form(cfg: CFG) -> CFG:
@@ -70,18 +75,32 @@ def hellings_based_cfpq(
     graph: DiGraph,
     start_nodes: set[int] = None,
     final_nodes: set[int] = None,
-) -> set[tuple[int, int]]:
+    as_matrix: bool = False,
+) -> set[tuple[int, int]] | ReachabilityResult:
     cfg_wnf = cfg_to_weak_normal_form(cfg)
     new_edges = _hellings_terminal_rules(cfg_wnf, graph)
     new_edges = _hellings_nonterminal_rules(cfg_wnf, new_edges)
 
-    if start_nodes is None:
-        start_nodes = graph.nodes
-    if final_nodes is None:
-        final_nodes = graph.nodes
-
-    res = set()
+    nodes = node_array(graph.nodes)
+    index_of_node = {node: index for index, node in enumerate(nodes.tolist())}
+    sources, targets = [], []
     for fst, var, snd in new_edges:
-        if var == cfg_wnf.start_symbol and fst in start_nodes and snd in final_nodes:
-            res.add((fst, snd))
-    return res
+        if var == cfg_wnf.start_symbol:
+            sources.append(index_of_node[fst])
+            targets.append(index_of_node[snd])
+    reached = csr_matrix(
+        (np.ones(len(sources), dtype=bool), (sources, targets)),
+        shape=(len(nodes), len(nodes)),
+        dtype=bool,
+    )
+
+    start_mask = None
+    if start_nodes is not None:
+        start_mask = np.array([node in start_nodes for node in nodes.tolist()])
+    final_mask = None
+    if final_nodes is not None:
+        final_mask = np.array([node in final_nodes for node in nodes.tolist()])
+    indices = np.arange(len(nodes))
+    return extract_answers(
+        reached, nodes, indices, indices, start_mask, final_mask, as_matrix
+    )
@@ -0,0 +1,131 @@
+from scipy.sparse import csr_matrix, identity, kron, random as sparse_random
+from project.bit_matrix import BitMatrix, bit_kron
+from project.matrix_backend import DensityPolicy
+from project.task3 import (
+    CLOSURE_MODES,
+    graph_to_adj_matrix_fa,
+    to_bit_matrix_fa,
+    transitive_closure,
+)
+from project.task4 import ms_bfs_based_rpq
+
+import cfpq_data as cfpq
+import numpy as np
+import pytest
+
+
+def _random_matrix(rows: int, cols: int, seed: int) -> csr_matrix:
+    mat = sparse_random(rows, cols, density=0.2, format="csr", random_state=seed)
+    return csr_matrix(mat, dtype=bool)
+
+
+@pytest.mark.parametrize("shape", [(1, 1), (5, 7), (64, 64), (70, 130), (3, 200)])
+def test_conversions(shape):
+    mat = _random_matrix(*shape, seed=0)
+    bits = BitMatrix.from_sparse(mat)
+    assert bits.shape == shape
+    assert bits.nnz == mat.nnz
+    assert (bits.toarray() == mat.toarray()).all()
+    assert (bits.tocsr() != mat).nnz == 0
+    assert (BitMatrix.from_dense(mat.toarray()).words == bits.words).all()
+    assert (bits.T.toarray() == mat.toarray().T).all()
+    rows, cols = mat.nonzero()
+    assert all(bits[i, j] for i, j in zip(rows, cols))
+
+
+def test_stored_zeros_are_not_bits():
+    mat = csr_matrix(([True, False, True], ([0, 1, 2], [0, 1, 0])), shape=(3, 3))
+    assert mat.nnz == 3
+    bits = BitMatrix.from_sparse(mat)
+    assert bits.nnz == 2 and not bits[1, 1]
+    ones = BitMatrix.from_dense(np.ones((3, 4), dtype=bool))
+    product = (mat @ ones).toarray()
+    assert (product == (mat.toarray() @ ones.toarray())).all()
+    assert not product[1].any()
+    # the operand itself is left as it was
+    assert mat.nnz == 3
+
+
+@pytest.mark.parametrize("rows, inner, cols", [(5, 7, 9), (70, 130, 65), (9, 3, 1)])
+def test_matmul(rows, inner, cols):
+    fst = _random_matrix(rows, inner, seed=1)
+    snd = _random_matrix(inner, cols, seed=2)
+    expected = (fst @ snd).toarray()
+    fst_bits, snd_bits = BitMatrix.from_sparse(fst), BitMatrix.from_sparse(snd)
+    assert ((fst_bits @ snd_bits).toarray() == expected).all()
+    assert ((fst @ snd_bits).toarray() == expected).all()
+    assert ((fst_bits @ snd).toarray() == expected).all()
+
+
+@pytest.mark.parametrize("rows, inner, cols", [(5, 7, 9), (70, 130, 65), (200, 3, 1)])
+def test_matmul_sparse_keeps_operands_packed(rows, inner, cols, monkeypatch):
+    fst = _random_matrix(rows, inner, seed=5)
+    snd = _random_matrix(inner, cols, seed=6)
+    expected = (fst @ snd).toarray()
+    fst_bits = BitMatrix.from_sparse(fst)
+
+    def unpack(*args, **kwargs):
+        raise AssertionError("operands must not be converted")
+
+    monkeypatch.setattr(BitMatrix, "tocsr", unpack)
+    monkeypatch.setattr(BitMatrix, "nonzero", unpack)
+    monkeypatch.setattr(BitMatrix, "from_sparse", unpack)
+    assert (fst_bits.matmul_transposed(snd.T.tocsr()).toarray() == expected).all()
+    assert ((fst_bits @ snd).toarray() == expected).all()
+
+
+def test_elementwise_and_kron():
+    fst, snd = _random_matrix(20, 30, seed=3), _random_matrix(20, 30, seed=4)
+    fst_bits, snd_bits = BitMatrix.from_sparse(fst), BitMatrix.from_sparse(snd)
+    assert ((fst_bits + snd_bits).toarray() == (fst + snd).toarray()).all()
+    assert ((fst + snd_bits).toarray() == (fst + snd).toarray()).all()
+    assert ((fst_bits > snd).toarray() == (fst > snd).toarray()).all()
+    assert ((fst < snd_bits).toarray() == (fst < snd).toarray()).all()
+    assert ((fst_bits - snd_bits).nnz) == (fst > snd).nnz
+    assert (bit_kron(fst_bits, snd_bits).toarray() == kron(fst, snd).toarray()).all()
+    stacked = BitMatrix.vstack([fst_bits[0:5, :], fst_bits[5:20]])
+    assert (stacked.words == fst_bits.words).all()
+    with pytest.raises(ValueError):
+        fst_bits + BitMatrix.identity(20)
+
+
+@pytest.mark.parametrize("mode", CLOSURE_MODES)
+def test_bit_matrix_fa_closure(mode):
+    graph = cfpq.labeled_two_cycles_graph(40, 30, labels=("a", "b"))
+    adj = graph_to_adj_matrix_fa(graph, {0}, {5})
+    bits = to_bit_matrix_fa(adj)
+    expected = adj.get_trans_closure(mode)
+    result = bits.get_trans_closure(mode)
+    assert isinstance(result, BitMatrix)
+    assert (result.toarray() == expected.toarray()).all()
+    assert bits.is_empty() == adj.is_empty()
+    for word in ["a", "aaaaa", "bab", "b" * 31 + "a" * 5]:
+        assert bits.accepts(word) == adj.accepts(word)
+
+    step = identity(71, format="csr", dtype=bool)
+    assert isinstance(step + bits.boolean_decompress["a"], BitMatrix)
+
+
+def test_semi_naive_closure_keeps_sparse_step(monkeypatch):
+    graph = cfpq.labeled_two_cycles_graph(40, 30, labels=("a", "b"))
+    step = graph_to_adj_matrix_fa(graph, {0}, {5})._step_matrix()
+    expected, _ = transitive_closure(step, "semi_naive")
+
+    def matmul_bits(*args, **kwargs):
+        raise AssertionError("the step must not be packed into bits")
+
+    monkeypatch.setattr(BitMatrix, "__matmul__", matmul_bits)
+    policy = DensityPolicy("csr", "bits", threshold=0.0)
+    result, _ = transitive_closure(step, "semi_naive", policy)
+    assert isinstance(result, BitMatrix)
+    assert (result.toarray() == expected.toarray()).all()
+
+
+@pytest.mark.parametrize("regex", ["a* b b*", "(a|b)*", "a a b*"])
+def test_ms_bfs_bit_front(regex):
+    graph = cfpq.labeled_two_cycles_graph(20, 15, labels=("a", "b"))
+    start_nodes = {0, 3, 17, 25}
+    expected = ms_bfs_based_rpq(regex, graph, start_nodes, set())
+    assert ms_bfs_based_rpq(regex, graph, start_nodes, set(), bit_front=True) == (
+        expected
+    )
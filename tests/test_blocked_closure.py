@@ -0,0 +1,73 @@
+import os
+
+from scipy.sparse import csr_matrix, identity, random as sparse_random
+from project.blocked_closure import (
+    TILE_BUFFERS,
+    TiledMatrix,
+    block_size_for_budget,
+    blocked_transitive_closure,
+    tile_bytes,
+)
+from project.matrix_backend import to_csr
+from project.task3 import graph_to_adj_matrix_fa, tensor_based_rpq
+
+import cfpq_data as cfpq
+import numpy as np
+import pytest
+
+
+def _random_step(size: int, density: float, seed: int) -> csr_matrix:
+    mat = sparse_random(size, size, density=density, format="csr", random_state=seed)
+    return csr_matrix(mat, dtype=bool) + identity(size, format="csr", dtype=bool)
+
+
+def test_budget_bounds_tiles():
+    for budget in [1 << 12, 1 << 16, 1 << 20, 5 * 10**6]:
+        block_size = block_size_for_budget(budget)
+        assert block_size % 64 == 0
+        assert block_size == 64 or TILE_BUFFERS * tile_bytes(block_size) <= budget
+        assert TILE_BUFFERS * tile_bytes(block_size + 64) > budget
+
+
+def test_tiled_matrix_round_trip(tmp_path):
+    mat = _random_step(200, 0.02, seed=0)
+    tiled = TiledMatrix.from_sparse(mat, 64, str(tmp_path))
+    assert tiled.nnz == mat.nnz and tiled.blocks_number == 4
+    assert (tiled.tocsr() != mat).nnz == 0
+    assert (to_csr(tiled) != mat).nnz == 0
+    rows = np.array([199, 3, 70, 3])
+    assert (tiled.rows(rows) != mat[rows]).nnz == 0
+    coords = np.argwhere(mat.toarray())[:20]
+    assert all(tiled[i, j] for i, j in coords)
+    # empty tiles are not written
+    files = len(os.listdir(tmp_path))
+    assert files == np.count_nonzero(tiled._tile_nnz)
+
+
+@pytest.mark.parametrize("size, density", [(150, 0.01), (300, 0.003), (130, 0.1)])
+def test_blocked_closure_matches_squaring(size, density):
+    step = _random_step(size, density, seed=size)
+    expected = step
+    while True:
+        squared = expected @ expected
+        if squared.nnz == expected.nnz:
+            break
+        expected = squared
+    # the smallest budget gives 64 x 64 tiles
+    closure = blocked_transitive_closure(step, memory_budget=1)
+    assert closure.block_size == 64
+    assert closure.nnz == expected.nnz
+    assert (closure.tocsr() != expected).nnz == 0
+
+
+def test_tensor_rpq_with_memory_budget():
+    graph = cfpq.labeled_two_cycles_graph(40, 30, labels=("a", "b"))
+    start_nodes = {0, 5, 17, 30}
+    adj = graph_to_adj_matrix_fa(graph, start_nodes, set())
+    closure = adj.get_blocked_trans_closure(1)
+    assert (closure.tocsr() != adj.get_trans_closure()).nnz == 0
+    for regex in ["a* b b*", "(a|b)*", "a a b*"]:
+        expected = tensor_based_rpq(regex, graph, start_nodes, set())
+        assert tensor_based_rpq(regex, graph, start_nodes, set(), memory_budget=1) == (
+            expected
+        )
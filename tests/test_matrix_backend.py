@@ -0,0 +1,120 @@
+from scipy.sparse import csr_matrix, kron, random as sparse_random
+from project.bit_matrix import BitMatrix
+from project.matrix_backend import (
+    BACKENDS,
+    DensityPolicy,
+    MatrixBackend,
+    backend_of,
+    density,
+    get_backend,
+    matmul,
+    nnz,
+    to_csr,
+)
+from project.task3 import (
+    CLOSURE_MODES,
+    graph_to_adj_matrix_fa,
+    tensor_based_rpq,
+    to_backend_matrix_fa,
+)
+from project.task4 import ms_bfs_based_rpq
+
+import cfpq_data as cfpq
+import numpy as np
+import pytest
+
+
+def _random_matrix(rows: int, cols: int, seed: int) -> csr_matrix:
+    mat = sparse_random(rows, cols, density=0.2, format="csr", random_state=seed)
+    return csr_matrix(mat, dtype=bool)
+
+
+@pytest.mark.parametrize("name", list(BACKENDS))
+def test_backend_operations(name):
+    backend = get_backend(name)
+    fst, snd = _random_matrix(12, 9, seed=0), _random_matrix(9, 7, seed=1)
+    fst_b, snd_b = backend.convert(fst), backend.convert(snd)
+    assert backend.owns(fst_b) and backend_of(fst_b) is backend
+    assert nnz(fst_b) == fst.nnz
+    assert (to_csr(matmul(fst_b, snd_b)) != fst @ snd).nnz == 0
+    assert (to_csr(backend.kron(fst_b, snd_b)) != kron(fst, snd)).nnz == 0
+    stacked = backend.vstack([fst_b, backend.convert(fst)])
+    assert stacked.shape == (24, 9) and nnz(stacked) == 2 * fst.nnz
+    assert nnz(backend.identity(5)) == 5
+    assert nnz(backend.zeros((3, 4))) == 0
+    rows, cols = fst.nonzero()
+    built = backend.from_coords(fst.shape, rows, cols)
+    assert (to_csr(built) != fst).nnz == 0
+    with pytest.raises(ValueError):
+        get_backend("unknown")
+
+
+@pytest.mark.parametrize("fmt", ["csr", "csc"])
+def test_matmul_keeps_sparse_operand_sparse(fmt, monkeypatch):
+    fst, snd = _random_matrix(12, 9, seed=0), _random_matrix(9, 7, seed=1)
+    expected = (fst @ snd).toarray()
+    front, graph_mat = fst.toarray(), snd.asformat(fmt)
+
+    def densify(self, *args, **kwargs):
+        raise AssertionError("the sparse operand must not be densified")
+
+    monkeypatch.setattr(type(graph_mat), "toarray", densify)
+    monkeypatch.setattr(type(graph_mat), "todense", densify)
+    result = matmul(front, graph_mat)
+    assert isinstance(result, np.ndarray) and result.dtype == bool
+    assert (result == expected).all()
+    assert (matmul(graph_mat.T, front.T) == expected.T).all()
+
+
+def test_backend_must_define_conversion():
+    class HalfBackend(MatrixBackend):
+        def owns(self, mat):
+            return False
+
+    with pytest.raises(TypeError):
+        HalfBackend()
+
+
+def test_density_policy_switches_with_hysteresis():
+    policy = DensityPolicy(sparse="csr", dense="bits", threshold=0.2)
+    sparse = csr_matrix(np.eye(10, dtype=bool))
+    assert density(sparse) == 0.1
+    assert policy.adapt(sparse).format == "csr"
+
+    dense = csr_matrix(np.tri(10, dtype=bool))
+    switched = policy.adapt(dense)
+    assert isinstance(switched, BitMatrix)
+    # 0.1 is still above half of the threshold
+    assert isinstance(policy.adapt(BitMatrix.from_sparse(sparse)), BitMatrix)
+    empty = BitMatrix((10, 10))
+    assert policy.adapt(empty).format == "csr"
+
+
+@pytest.mark.parametrize("name", ["csr", "csc", "dense", "bits"])
+def test_automaton_in_backend(name):
+    graph = cfpq.labeled_two_cycles_graph(7, 5, labels=("a", "b"))
+    adj = graph_to_adj_matrix_fa(graph, {0}, {3})
+    converted = to_backend_matrix_fa(adj, name)
+    for mode in CLOSURE_MODES:
+        expected = adj.get_trans_closure(mode)
+        result = converted.get_trans_closure(mode)
+        assert backend_of(result) is get_backend(name)
+        assert (to_csr(result) != expected).nnz == 0
+    assert converted.is_empty() == adj.is_empty()
+    assert converted.accepts("aaa") and not converted.accepts("ab")
+
+
+@pytest.mark.parametrize("sparse_name", ["csr", "csc", "lil"])
+@pytest.mark.parametrize("dense_name", ["dense", "bits"])
+def test_engines_with_policy(sparse_name, dense_name):
+    graph = cfpq.labeled_two_cycles_graph(20, 15, labels=("a", "b"))
+    start_nodes = {0, 5, 17, 30}
+    policy = DensityPolicy(sparse_name, dense_name, threshold=0.01)
+    for regex in ["a* b b*", "(a|b)*", "a a b*"]:
+        expected = tensor_based_rpq(regex, graph, start_nodes, set())
+        assert tensor_based_rpq(regex, graph, start_nodes, set(), policy=policy) == (
+            expected
+        )
+        assert ms_bfs_based_rpq(regex, graph, start_nodes, set(), policy=policy) == (
+            expected
+        )
@@ -0,0 +1,64 @@
+from scipy.sparse import csr_matrix
+from project.parallel import map_labels, parallel_map, parallel_sum, resolve_workers
+from project.task3 import (
+    graph_to_adj_matrix_fa,
+    intersect_automata,
+    regex_to_nfa_matrix_fa,
+    tensor_based_rpq,
+)
+from project.task4 import ms_bfs_based_rpq
+
+import cfpq_data as cfpq
+import numpy as np
+import pytest
+
+
+def test_map_keeps_order_and_nests():
+    items = list(range(50))
+    assert parallel_map(lambda x: x * x, items, workers=4) == [x * x for x in items]
+    nested = parallel_map(
+        lambda x: parallel_map(lambda y: x + y, range(3), workers=4), range(6), 4
+    )
+    assert nested == [[x, x + 1, x + 2] for x in range(6)]
+    assert parallel_map(str, [], workers=4) == []
+    assert list(map_labels(str, {"c", "a", "b"}, workers=3)) == ["a", "b", "c"]
+    assert resolve_workers(None) >= 1
+    with pytest.raises(ValueError):
+        resolve_workers(0)
+
+
+def test_sum_is_exact():
+    mats = [csr_matrix(np.eye(7, k=k, dtype=bool)) for k in range(-3, 4)]
+    expected = csr_matrix((7, 7), dtype=bool)
+    for mat in mats:
+        expected = expected + mat
+    for workers in [1, 2, 5]:
+        assert (parallel_sum(mats, workers) != expected).nnz == 0
+    with pytest.raises(ValueError):
+        parallel_sum([])
+
+
+def test_engines_with_workers():
+    graph = cfpq.labeled_two_cycles_graph(20, 15, labels=("a", "b"))
+    for edge, label in [((0, 3), "c"), ((5, 7), "d"), ((30, 2), "c")]:
+        graph.add_edge(*edge, label=label)
+    start_nodes = {0, 5, 17, 30}
+    regex = "(a|c)* b (b|d)*"
+    expected = tensor_based_rpq(regex, graph, start_nodes, set(), workers=1)
+    for options in [{}, {"lazy": True}, {"from_starts": True}]:
+        for workers in [2, 4]:
+            result = tensor_based_rpq(
+                regex, graph, start_nodes, set(), workers=workers, **options
+            )
+            assert result == expected
+    assert ms_bfs_based_rpq(regex, graph, start_nodes, set(), workers=4) == expected
+
+    query = regex_to_nfa_matrix_fa(regex)
+    graph_fa = graph_to_adj_matrix_fa(graph, start_nodes, set(), workers=4)
+    fst = intersect_automata(query, graph_fa, workers=1)
+    snd = intersect_automata(query, graph_fa, workers=4)
+    assert list(fst.boolean_decompress) == list(snd.boolean_decompress)
+    for symbol, mat in fst.boolean_decompress.items():
+        assert (mat != snd.boolean_decompress[symbol]).nnz == 0
+    closure = fst.get_trans_closure(workers=4)
+    assert (closure != fst.get_trans_closure(workers=1)).nnz == 0
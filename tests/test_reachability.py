@@ -0,0 +1,115 @@
+from pyformlang.cfg import CFG
+from scipy.sparse import csr_matrix
+from project.reachability import ReachabilityResult, extract_answers, node_array
+from project.task3 import tensor_based_rpq
+from project.task4 import ms_bfs_based_rpq
+from project.task6 import hellings_based_cfpq
+
+import cfpq_data as cfpq
+import numpy as np
+import pytest
+
+
+def test_result_behaves_like_set():
+    pairs = {(0, 1), (2, 2), (5, 0)}
+    result = ReachabilityResult.from_pairs(pairs, [0, 1, 2, 5, 7])
+    assert len(result) == 3
+    assert (2, 2) in result and (0, 1) in result
+    assert (1, 0) not in result and (7, 42) not in result and 3 not in result
+    assert set(result) == pairs == result.to_set()
+    assert result == pairs and pairs == result
+    assert result != {(0, 1)}
+    assert result == ReachabilityResult.from_pairs(pairs, [7, 5, 2, 1, 0])
+    sources, targets = result.to_numpy()
+    assert sources.dtype == np.int64
+    assert set(zip(sources.tolist(), targets.tolist())) == pairs
+
+
+def test_result_with_object_nodes():
+    nodes = node_array(["a", ("b", 1), 3])
+    assert nodes.dtype == object and len(nodes) == 3
+    result = ReachabilityResult.from_indices(
+        np.array([0, 1]), np.array([1, 2]), nodes, nodes
+    )
+    assert result == {("a", ("b", 1)), (("b", 1), 3)}
+    assert ("a", 3) not in result
+
+
+def test_result_keeps_callers_matrix():
+    nodes = np.arange(3)
+    matrix = csr_matrix(
+        (np.array([True, False, True]), (np.array([0, 1, 2]), np.array([1, 1, 0]))),
+        shape=(3, 3),
+    )
+    result = ReachabilityResult(matrix, nodes, nodes)
+    assert matrix.nnz == 3 and result.matrix.nnz == 2
+    assert result == {(0, 1), (2, 0)}
+    # results over the same nodes are compared as matrices
+    same = ReachabilityResult(matrix.toarray(), nodes, np.arange(3))
+    assert result == same and same == result
+    assert result != ReachabilityResult(matrix.T, nodes, nodes)
+    objects = node_array(["a", ("b", 1), 3])
+    assert ReachabilityResult(matrix, objects, objects) == {
+        ("a", ("b", 1)),
+        (3, "a"),
+    }
+    assert ReachabilityResult(matrix, objects, objects) != result
+
+
+def test_extract_answers_masks_and_maps():
+    reached = csr_matrix(
+        np.array(
+            [
+                [1, 0, 1, 0],
+                [0, 1, 0, 1],
+                [1, 1, 0, 0],
+            ],
+            dtype=bool,
+        )
+    )
+    nodes = node_array([10, 20, 30])
+    row_nodes = np.array([0, 1, 2])
+    col_nodes = np.array([0, 1, 2, 0])
+    assert extract_answers(reached, nodes, row_nodes, col_nodes) == {
+        (10, 10),
+        (10, 30),
+        (20, 20),
+        (20, 10),
+        (30, 10),
+        (30, 20),
+    }
+    row_mask = np.array([True, True, False])
+    col_mask = np.array([False, True, True, True])
+    result = extract_answers(
+        reached, nodes, row_nodes, col_nodes, row_mask, col_mask, as_matrix=True
+    )
+    assert isinstance(result, ReachabilityResult)
+    assert result == {(10, 30), (20, 20), (20, 10)}
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"lazy": True}, {"from_starts": True}],
+)
+def test_tensor_based_rpq_as_matrix(options):
+    graph = cfpq.labeled_two_cycles_graph(20, 15, labels=("a", "b"))
+    for regex in ["a* b b*", "b a", "c"]:
+        for start_nodes in [{0, 5, 17}, set()]:
+            expected = tensor_based_rpq(regex, graph, start_nodes, set(), **options)
+            result = tensor_based_rpq(
+                regex, graph, start_nodes, set(), as_matrix=True, **options
+            )
+            assert isinstance(result, ReachabilityResult)
+            assert result == expected
+
+
+def test_ms_bfs_and_hellings_as_matrix():
+    graph = cfpq.labeled_two_cycles_graph(10, 8, labels=("a", "b"))
+    expected = ms_bfs_based_rpq("a* b", graph, {0, 3}, set())
+    assert ms_bfs_based_rpq("a* b", graph, {0, 3}, set(), as_matrix=True) == expected
+
+    cfg = CFG.from_text("S -> a S b | a b")
+    expected = hellings_based_cfpq(cfg, graph)
+    result = hellings_based_cfpq(cfg, graph, as_matrix=True)
+    assert isinstance(result, ReachabilityResult)
+    assert result == expected
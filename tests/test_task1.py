@@ -1,15 +1,26 @@
 from pathlib import Path
 from typing import List
 from pyparsing import Any
-from networkx import is_isomorphic
+from networkx import MultiDiGraph, is_isomorphic
 from networkx.drawing.nx_pydot import read_dot
 from scripts.shared import TESTS
 from project.task1 import (
     GraphMetaData,
     get_graph_meta_data,
     create_two_cycles_graph_and_save_to_dot,
+    graph_matrices_from_csv,
+    load_cached_graph,
+    load_graph,
+    load_graph_matrices,
+    load_graph_statistics,
+    read_graph_from_dot,
+    write_graph_to_dot,
+    write_matrices_to_dot,
+    write_matrices_to_edge_list,
 )
 
+import cfpq_data as cfpq
+
 import pytest
 
 EXPECTED_DOTS = TESTS / Path("resources/task1")
@@ -127,3 +138,261 @@ def test_create_two_cycles_graph_and_save_to_dot_valid_cycles(
         edge_match=lambda e1, e2: dict(e1) == dict(e2),
         node_match=lambda n1, n2: dict(n1) == dict(n2),
     )
+
+
+def _write_graph_csv(path, lines):
+    path.write_text("".join(f"{fst} {snd} {lbl}\n" for fst, snd, lbl in lines))
+    return path
+
+
+def test_get_graph_meta_data_from_cache(tmp_path, monkeypatch):
+    csv_path = _write_graph_csv(
+        tmp_path / "g.csv", [(0, 1, "b"), (1, 2, "a"), (2, 0, "b"), (2, 3, "c")]
+    )
+    monkeypatch.setattr(cfpq, "download", lambda name: csv_path)
+
+    cache_dir = tmp_path / "cache"
+    expected = GraphMetaData(4, 4, ["b", "a", "c"])
+    assert get_graph_meta_data("g", cache_dir) == expected
+    assert (cache_dir / "g.npz").exists()
+
+    def download_offline(name):
+        raise AssertionError("offline mode must not download cached graphs")
+
+    monkeypatch.setattr(cfpq, "download", download_offline)
+    assert get_graph_meta_data("g", cache_dir, offline=True) == expected
+
+
+def test_load_graph_from_cache_is_isomorphic(tmp_path, monkeypatch):
+    csv_path = _write_graph_csv(
+        tmp_path / "g.csv", [(0, 1, "a"), (1, 0, "b"), (1, 1, "a"), (1, 1, "a")]
+    )
+    monkeypatch.setattr(cfpq, "download", lambda name: csv_path)
+
+    expected = cfpq.graph_from_csv(csv_path)
+    load_graph("g", tmp_path)
+    result = load_graph("g", tmp_path)
+    assert is_isomorphic(
+        expected, result, edge_match=lambda e1, e2: dict(e1) == dict(e2)
+    )
+
+
+def test_graph_cache_is_invalidated_by_checksum(tmp_path, monkeypatch):
+    csv_path = _write_graph_csv(tmp_path / "g.csv", [(0, 1, "a")])
+    monkeypatch.setattr(cfpq, "download", lambda name: csv_path)
+    assert load_cached_graph("g", tmp_path).number_of_edges() == 1
+
+    _write_graph_csv(csv_path, [(0, 1, "a"), (1, 2, "b")])
+    cached = load_cached_graph("g", tmp_path)
+    assert cached.number_of_edges() == 2
+    assert cached.labels == ["a", "b"]
+
+
+def test_graph_cache_keeps_numeric_labels(tmp_path, monkeypatch):
+    csv_path = _write_graph_csv(
+        tmp_path / "g.csv", [(0, 1, 2), (1, 2, 1), (2, 0, 2), (2, 2, 1)]
+    )
+    monkeypatch.setattr(cfpq, "download", lambda name: csv_path)
+
+    expected = cfpq.graph_from_csv(csv_path)
+    cold = load_graph("g", tmp_path)
+    warm = load_graph("g", tmp_path, offline=True)
+    for result in [cold, warm]:
+        assert sorted(lbl for _, _, lbl in result.edges(data="label")) == sorted(
+            lbl for _, _, lbl in expected.edges(data="label")
+        )
+        assert is_isomorphic(
+            expected, result, edge_match=lambda e1, e2: dict(e1) == dict(e2)
+        )
+    assert load_cached_graph("g", tmp_path, offline=True).labels == [1, 2]
+    assert load_graph_statistics("g", tmp_path, offline=True).labels == [1, 2]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 100])
+def test_graph_matrices_from_csv(tmp_path, chunk_size):
+    csv_path = _write_graph_csv(
+        tmp_path / "g.csv",
+        [(5, 7, "a"), (7, 9, "b"), (9, 5, "a"), (7, 9, "b"), (9, 9, "c")],
+    )
+    graph = cfpq.graph_from_csv(csv_path)
+    result = graph_matrices_from_csv(csv_path, chunk_size)
+
+    assert result.nodes.tolist() == list(graph.nodes)
+    assert set(result.matrices) == {"a", "b", "c"}
+    for label, mat in result.matrices.items():
+        expected = {(u, v) for u, v, lbl in graph.edges(data="label") if lbl == label}
+        rows, cols = mat.nonzero()
+        actual = {(result.nodes[i], result.nodes[j]) for i, j in zip(rows, cols)}
+        assert actual == expected
+
+
+def test_graph_matrices_from_csv_types_columns_once(tmp_path):
+    # "1" is a string label because of "a", wherever the chunks are cut
+    csv_path = _write_graph_csv(
+        tmp_path / "g.csv",
+        [(0, 1, 1), (1, 2, 1), (2, 0, "a"), (0, 2, 1), (3, 0, 1)],
+    )
+    graph = cfpq.graph_from_csv(csv_path)
+    expected = sorted(set(lbl for _, _, lbl in graph.edges(data="label")))
+    assert expected == ["1", "a"]
+    results = [graph_matrices_from_csv(csv_path, size) for size in [1, 2, 3, 10]]
+    for result in results:
+        assert sorted(result.matrices) == expected
+        assert result.nodes.tolist() == list(graph.nodes)
+        for label, mat in result.matrices.items():
+            assert (mat != results[0].matrices[label]).nnz == 0
+
+
+def test_graph_matrices_from_csv_keeps_na_tokens(tmp_path):
+    csv_path = _write_graph_csv(
+        tmp_path / "g.csv", [(1, "NA", "b"), (2, 3, "null"), ("nan", 1, "None")]
+    )
+    result = graph_matrices_from_csv(csv_path, chunk_size=2)
+
+    assert result.nodes.tolist() == ["1", "NA", "2", "3", "nan"]
+    edges = set()
+    for label, mat in result.matrices.items():
+        rows, cols = mat.nonzero()
+        edges |= {(result.nodes[i], result.nodes[j], label) for i, j in zip(rows, cols)}
+    assert edges == {("1", "NA", "b"), ("2", "3", "null"), ("nan", "1", "None")}
+
+
+def test_load_graph_matrices_matches_csv(tmp_path, monkeypatch):
+    csv_path = _write_graph_csv(
+        tmp_path / "g.csv", [(0, 1, "a"), (1, 2, "b"), (2, 0, "a")]
+    )
+    monkeypatch.setattr(cfpq, "download", lambda name: csv_path)
+
+    expected = graph_matrices_from_csv(csv_path)
+    result = load_graph_matrices("g", tmp_path)
+    assert result.nodes.tolist() == expected.nodes.tolist()
+    for label in expected.matrices:
+        assert (result.matrices[label] != expected.matrices[label]).nnz == 0
+
+
+def test_load_graph_statistics_from_sidecar(tmp_path, monkeypatch):
+    csv_path = _write_graph_csv(
+        tmp_path / "g.csv", [(0, 1, "a"), (0, 2, "a"), (1, 2, "b"), (2, 0, "a")]
+    )
+    monkeypatch.setattr(cfpq, "download", lambda name: csv_path)
+
+    stats = load_graph_statistics("g", tmp_path)
+    assert stats.nodes_number == 3
+    assert stats.edges_number == 4
+    assert stats.labels == ["a", "b"]
+    assert stats.label_frequency == [3, 1]
+    assert stats.label_sources == [2, 1]
+    assert stats.label_targets == [3, 1]
+    assert stats.label_density == [3 / 9, 1 / 9]
+    assert stats.max_out_degree == 2
+    assert stats.max_in_degree == 2
+
+    # the sidecar alone is enough to answer in offline mode
+    (tmp_path / "g.npz").unlink()
+    assert load_graph_statistics("g", tmp_path, offline=True) == stats
+    assert get_graph_meta_data("g", tmp_path, offline=True) == GraphMetaData(
+        3, 4, ["a", "b"]
+    )
+
+
+def test_graph_statistics_refresh(tmp_path, monkeypatch):
+    csv_path = _write_graph_csv(tmp_path / "g.csv", [(0, 1, "a")])
+    monkeypatch.setattr(cfpq, "download", lambda name: csv_path)
+    assert get_graph_meta_data("g", tmp_path) == GraphMetaData(2, 1, ["a"])
+
+    def download_once(name):
+        raise AssertionError("an existing sidecar must be served as is")
+
+    monkeypatch.setattr(cfpq, "download", download_once)
+    _write_graph_csv(csv_path, [(0, 1, "a"), (1, 2, "b")])
+    assert get_graph_meta_data("g", tmp_path) == GraphMetaData(2, 1, ["a"])
+
+    # only an explicit refresh looks at the dataset again
+    monkeypatch.setattr(cfpq, "download", lambda name: csv_path)
+    assert get_graph_meta_data("g", tmp_path, refresh=True) == GraphMetaData(
+        3, 2, ["a", "b"]
+    )
+    assert load_cached_graph("g", tmp_path, offline=True).number_of_edges() == 2
+
+
+def test_write_and_read_graph_dot_round_trip(tmp_path):
+    graph = cfpq.labeled_two_cycles_graph(3, 2, labels=("a", 'b "quoted"'))
+    graph.add_node("some node", color="red")
+    graph.add_edge(0, "some node", label="c")
+    path = tmp_path / "graph.dot"
+    write_graph_to_dot(graph, path)
+    result = read_graph_from_dot(path)
+    assert is_isomorphic(
+        graph,
+        result,
+        edge_match=lambda e1, e2: dict(e1) == dict(e2),
+        node_match=lambda n1, n2: dict(n1) == dict(n2),
+    )
+    assert set(result.nodes) == set(graph.nodes)
+
+
+def test_dot_round_trip_keeps_line_breaks(tmp_path):
+    graph = MultiDiGraph()
+    graph.add_edge("x", "y\nz", label="a\nb")
+    graph.add_edge("x", "x", label="c\r\\n")
+    graph.add_node("x", note='"\n"')
+    path = tmp_path / "graph.dot"
+    write_graph_to_dot(graph, path)
+    result = read_graph_from_dot(path)
+    assert set(result.edges(data="label")) == set(graph.edges(data="label"))
+    assert result.nodes["x"] == {"note": '"\n"'}
+
+
+def test_read_graph_from_dot_rejects_unknown_lines(tmp_path):
+    path = tmp_path / "graph.dot"
+    path.write_text('digraph  {\nx -> y [label="a\nb"];\n}\n')
+    with pytest.raises(ValueError):
+        read_graph_from_dot(path)
+
+
+def test_write_graph_dot_quotes_keywords(tmp_path):
+    graph = MultiDiGraph()
+    for fst, snd in [("node", "graph"), ("Edge", -3), (-3, "strict"), (0.5, "x")]:
+        graph.add_edge(fst, snd, label="digraph")
+    graph.add_node("subgraph", **{"node": "edge", "a b": -1})
+    path = tmp_path / "graph.dot"
+    write_graph_to_dot(graph, path)
+
+    # pydot reads every name back as a string and keeps the quotes of
+    # attributes
+    result = read_dot(path)
+    assert set(result.nodes) == {str(node) for node in graph.nodes}
+    assert {(u, v, lbl) for u, v, lbl in result.edges(data="label")} == {
+        (str(u), str(v), f'"{lbl}"') for u, v, lbl in graph.edges(data="label")
+    }
+    assert result.nodes["subgraph"] == {'"node"': '"edge"', '"a b"': '"-1"'}
+
+    result = read_graph_from_dot(path)
+    nodes = {"node", "graph", "Edge", "-3", "strict", "0.5", "x", "subgraph"}
+    assert set(result.nodes) == nodes
+    assert result.nodes["subgraph"] == {"node": "edge", "a b": "-1"}
+
+
+def test_write_matrices_matches_graph(tmp_path):
+    csv_path = _write_graph_csv(
+        tmp_path / "g.csv", [(3, 1, "a"), (1, 2, "b"), (2, 3, "a"), (2, 2, "a")]
+    )
+    graph = cfpq.graph_from_csv(csv_path)
+    matrices = graph_matrices_from_csv(csv_path)
+
+    dot_path = tmp_path / "m.dot"
+    write_matrices_to_dot(matrices, dot_path, block_size=1)
+    assert is_isomorphic(
+        graph,
+        read_graph_from_dot(dot_path),
+        edge_match=lambda e1, e2: dict(e1) == dict(e2),
+    )
+
+    edge_list_path = tmp_path / "m.csv"
+    write_matrices_to_edge_list(matrices, edge_list_path, block_size=2)
+    result = graph_matrices_from_csv(edge_list_path)
+    for label, mat in matrices.matrices.items():
+        rows, cols = mat.nonzero()
+        expected = set(zip(matrices.nodes[rows], matrices.nodes[cols]))
+        rows, cols = result.matrices[label].nonzero()
+        assert set(zip(result.nodes[rows], result.nodes[cols])) == expected
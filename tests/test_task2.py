@@ -1,10 +1,17 @@
 from project.task1 import create_two_cycles_graph_and_save_to_dot, get_graph_meta_data
-from project.task2 import regex_to_dfa, graph_to_nfa
+from project.task2 import (
+    REGEX_CACHE,
+    RegexCache,
+    RegexCacheInfo,
+    regex_to_dfa,
+    regex_to_glushkov,
+    graph_to_nfa,
+)
 from networkx.drawing.nx_pydot import read_dot
 from networkx import relabel_nodes
 import pytest
 import cfpq_data as cfpq
-from pyformlang.regular_expression import MisformedRegexError
+from pyformlang.regular_expression import MisformedRegexError, Regex
 
 
 def test_regex_to_dfa_empty_regex():
@@ -119,3 +126,117 @@ def test_graph_to_nfa_from_dot(
     else:
         assert final_states == nfa.final_states
     assert set(cfpq.get_sorted_labels(graph)) == nfa.symbols
+
+
+def test_regex_cache_hits_and_evictions():
+    cache = RegexCache(maxsize=2)
+    fst = cache.get("a b*")
+    assert fst.glushkov.states_number == 3
+    assert cache.get("  a   b* ") is fst
+    assert cache.get("c").dfa.accepts(["c"])
+    assert cache.get("d").glushkov.final_states == {1}
+    assert cache.info() == RegexCacheInfo(
+        hits=1, misses=3, evictions=1, size=2, maxsize=2
+    )
+    assert cache.get("a b*") is not fst
+    assert cache.info().misses == 4
+
+    cache.clear()
+    assert cache.info() == RegexCacheInfo(0, 0, 0, 0, 2)
+
+
+def test_regex_cache_keeps_tabs_in_symbols():
+    cache = RegexCache()
+    assert cache.get("a\tb") is not cache.get("a b")
+    assert regex_to_dfa("a\tb").symbols == Regex("a\tb").to_epsilon_nfa().symbols
+    assert regex_to_dfa("a\tb").accepts(["a\tb"])
+
+
+# Glushkov automata are run as sets of states over symbol matrices
+def _glushkov_accepts(glushkov, word):
+    states = {0}
+    for symbol in word:
+        mat = glushkov.matrices.get(symbol)
+        states = set() if mat is None else set(mat[sorted(states)].indices)
+    return bool(states & glushkov.final_states)
+
+
+@pytest.mark.parametrize("regex", ["a\tb", "a \t b*", "(\ta|b\n)* c"])
+def test_glushkov_keeps_tabs_like_pyformlang(regex):
+    glushkov = regex_to_glushkov(regex)
+    nfa = Regex(regex).to_epsilon_nfa()
+    symbols = {str(symbol) for symbol in nfa.symbols}
+    assert set(glushkov.matrices) == symbols
+    for word in [[], ["a\tb"], ["a", "\t", "b"], ["\ta", "b\n", "c"], ["c"]]:
+        assert _glushkov_accepts(glushkov, word) == nfa.accepts(word)
+
+
+def test_regex_cache_parses_misformed_regex_on_use():
+    cache = RegexCache()
+    compiled = cache.get("(|)*")
+    with pytest.raises(MisformedRegexError):
+        _ = compiled.dfa
+    with pytest.raises(MisformedRegexError):
+        _ = compiled.glushkov
+    assert cache.info().size == 0
+
+
+def test_regex_cache_misformed_regex_takes_no_slot():
+    cache = RegexCache(maxsize=1)
+    fst = cache.get("a b*")
+    assert fst.dfa.accepts(["a"])
+    with pytest.raises(MisformedRegexError):
+        _ = cache.get("(|)*").dfa
+    assert cache.get("a b*") is fst
+    assert cache.info().evictions == 0
+
+
+@pytest.mark.parametrize(
+    "regex", ["(a|)", "a|", "a b |", "(a|)*", "a* |", "(a.) b", "a | b |", "(a|) b"]
+)
+def test_empty_operands_like_pyformlang(regex):
+    dfa = regex_to_dfa(regex)
+    glushkov = regex_to_glushkov(regex)
+    words = ["", "a", "b", "ab", "aa", "ba", "aab"]
+    for word in words:
+        assert _glushkov_accepts(glushkov, word) == dfa.accepts(list(word))
+
+
+def test_regex_to_dfa_is_memoized():
+    REGEX_CACHE.clear()
+    fst = regex_to_dfa("(a | b)* c")
+    snd = regex_to_dfa("(a | b)*  c")
+    assert fst is not snd and fst.is_equivalent_to(snd)
+    assert REGEX_CACHE.info().hits == 1
+
+
+def test_regex_to_dfa_returns_private_copies():
+    dfa = regex_to_dfa("a b*")
+    start = next(iter(dfa.start_states))
+    dfa.add_transition(start, "z", start)
+    dfa.add_final_state(start)
+    fresh = regex_to_dfa("a  b*")
+    assert not fresh.accepts(["z"]) and not fresh.accepts([])
+
+    glushkov = regex_to_glushkov("a b*")
+    glushkov.final_states.add(0)
+    glushkov.matrices["a"][0, 0] = True
+    fresh = regex_to_glushkov("a b*")
+    assert 0 not in fresh.final_states and not fresh.matrices["a"][0, 0]
+
+
+def test_regex_to_glushkov_positions():
+    glushkov = regex_to_glushkov("(a | b)* c")
+    # one state per symbol occurrence plus the start state
+    assert glushkov.states_number == 4
+    assert glushkov.final_states == {3}
+    assert {symbol: mat.nnz for symbol, mat in glushkov.matrices.items()} == {
+        "a": 3,
+        "b": 3,
+        "c": 3,
+    }
+
+
+def test_regex_to_glushkov_incorrect_regex_entry():
+    with pytest.raises(MisformedRegexError):
+        regex_to_glushkov("(a | b")
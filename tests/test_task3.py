@@ -1,5 +1,31 @@
+from networkx import MultiDiGraph
 from pyformlang.finite_automaton import NondeterministicFiniteAutomaton, State, Symbol
-from project.task3 import AdjacencyMatrixFA, build_AdjMatrixFA_with_artefacts
+from scipy.sparse import csr_matrix, kron, vstack
+from project.task1 import graph_matrices_from_csv
+from project.task2 import graph_to_nfa, regex_to_glushkov
+from project import task3
+from project.task3 import (
+    PreparedGraph,
+    CLOSURE_MODES,
+    AdjacencyMatrixFA,
+    LazyKroneckerFA,
+    build_AdjMatrixFA_with_artefacts,
+    closure_rows,
+    determinize_if_smaller,
+    graph_matrices_to_adj_matrix_fa,
+    graph_to_adj_matrix_fa,
+    intersect_automata,
+    minimize_matrix_fa,
+    regex_to_matrix_fa,
+    regex_to_nfa_matrix_fa,
+    tensor_based_rpq,
+    transitive_closure,
+)
+
+import cfpq_data as cfpq
+import itertools
+import numpy as np
+import pytest
 
 
 # -> 0 -a-> 1 <-a---b-> (2)
@@ -25,6 +51,30 @@ def test_simple_words():
     assert adj.accepts("$") is False
 
 
+def test_accepts_forgets_previous_states():
+    nfa = NondeterministicFiniteAutomaton()
+    nfa.add_start_state(State(0))
+    nfa.add_final_state(State(1))
+    nfa.add_transition(State(0), Symbol("a"), State(1))
+    nfa.add_transition(State(1), Symbol("a"), State(2))
+    adj = AdjacencyMatrixFA(nfa)
+    assert adj.accepts("a")
+    assert not adj.accepts("aa")
+
+
+@pytest.mark.parametrize("regex", ["(a|b)*c", "a b* | c", "(a b d)* | (a b c)*"])
+def test_accepts_words_matches_accepts(regex):
+    adj = regex_to_matrix_fa(regex)
+    words = [
+        "".join(word)
+        for length in range(6)
+        for word in itertools.product("abcd", repeat=length)
+    ]
+    words += ["abc", "abc", ""]
+    assert adj.accepts_words(words) == [adj.accepts(word) for word in words]
+    assert adj.accepts_words([]) == []
+
+
 def test_no_final_states():
     nfa = NondeterministicFiniteAutomaton()
     nfa.add_start_state(State(0))
@@ -89,3 +139,362 @@ def test_boolean_decompress_correctness():
 
     assert mat_b[idx1, idx2] == 1
     assert mat_b.sum() == 1
+
+
+def test_init_from_edge_arrays():
+    nfa = make_simple_nfa()
+    expected = AdjacencyMatrixFA(nfa)
+    index_of_state = {State(0): 0, State(1): 1, State(2): 2}
+    state_of_index = {0: State(0), 1: State(1), 2: State(2)}
+    edges = {
+        Symbol("a"): (np.array([0, 2]), np.array([1, 1])),
+        Symbol("b"): (np.array([1]), np.array([2])),
+    }
+    adj = AdjacencyMatrixFA(
+        index_mapping=(index_of_state, state_of_index),
+        edges=edges,
+        start_states={State(0)},
+        final_states={State(2)},
+    )
+    assert adj.states == expected.states
+    assert adj.labels == expected.labels
+    assert _transitions(adj) == _transitions(expected)
+    for word in ["a", "ab", "abab", "ba", ""]:
+        assert adj.accepts(word) == expected.accepts(word)
+
+    with pytest.raises(ValueError):
+        AdjacencyMatrixFA(edges=edges)
+
+
+def test_init_large_automaton_is_sparse():
+    nodes_number = 50_000
+    nfa = NondeterministicFiniteAutomaton()
+    for i in range(nodes_number - 1):
+        nfa.add_transition(State(i), Symbol("ab"[i % 2]), State(i + 1))
+    nfa.add_start_state(State(0))
+    nfa.add_final_state(State(nodes_number - 1))
+    adj = AdjacencyMatrixFA(nfa)
+    assert adj.boolean_decompress[Symbol("a")].nnz == nodes_number // 2
+    assert adj.boolean_decompress[Symbol("b")].nnz == nodes_number // 2 - 1
+
+
+def _transitions(adj: AdjacencyMatrixFA) -> set:
+    result = set()
+    for symbol, mat in adj.boolean_decompress.items():
+        for i, j in zip(*mat.nonzero()):
+            result.add((adj.state_of_index.get(i), symbol, adj.state_of_index.get(j)))
+    return result
+
+
+@pytest.mark.parametrize(
+    "start_states, final_states",
+    [(set(), set()), ({0, 3}, set()), (set(), {1}), ({0, 100}, {2, 101})],
+)
+def test_graph_to_adj_matrix_fa_matches_nfa_path(start_states, final_states):
+    graph = cfpq.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    graph.add_edge(1, 1)
+    expected = AdjacencyMatrixFA(graph_to_nfa(graph, start_states, final_states))
+    result = graph_to_adj_matrix_fa(graph, start_states, final_states)
+
+    assert result.states == expected.states
+    assert result.start_states == expected.start_states
+    assert result.final_states == expected.final_states
+    assert result.labels == expected.labels
+    assert _transitions(result) == _transitions(expected)
+
+
+def test_graph_matrices_to_adj_matrix_fa(tmp_path):
+    csv_path = tmp_path / "g.csv"
+    csv_path.write_text("0 1 a\n1 2 b\n2 0 a\n")
+    matrices = graph_matrices_from_csv(csv_path)
+    graph = cfpq.graph_from_csv(csv_path)
+
+    result = graph_matrices_to_adj_matrix_fa(matrices, {0}, {2, 7})
+    expected = graph_to_adj_matrix_fa(graph, {0}, {2, 7})
+    assert result.states == expected.states
+    assert _transitions(result) == _transitions(expected)
+    assert result.accepts("ab") and not result.accepts("a")
+
+
+@pytest.mark.parametrize(
+    "regex",
+    [
+        "",
+        "$",
+        "a",
+        "a b|c",
+        "(a|b)*c",
+        "a**",
+        "a $ b",
+        "a.b|c*",
+        "(a b d)* | (a b c)*",
+        "((a | b)*c)*((d | e)*f)*",
+        "a*a*b",
+    ],
+)
+@pytest.mark.parametrize("determinize", [True, False])
+def test_regex_to_nfa_matrix_fa_language(regex, determinize):
+    expected = regex_to_matrix_fa(regex)
+    result = regex_to_nfa_matrix_fa(regex, determinize)
+    alphabet = "abcdef"
+    for length in range(5):
+        for word in itertools.product(alphabet, repeat=length):
+            assert result.accepts(word) == expected.accepts(word)
+
+
+@pytest.mark.parametrize("to_matrix_fa", [regex_to_matrix_fa, regex_to_nfa_matrix_fa])
+def test_regex_matrix_fa_returns_private_copies(to_matrix_fa):
+    automaton = to_matrix_fa("a b*")
+    automaton.final_states |= automaton.start_states
+    automaton.boolean_decompress["z"] = automaton.boolean_decompress["a"]
+    automaton.boolean_decompress["a"][:, :] = False
+    fresh = to_matrix_fa("a  b*")
+    assert not fresh.accepts("") and not fresh.accepts("z")
+    assert fresh.accepts("ab")
+    graph = MultiDiGraph()
+    graph.add_edge(0, 1, label="a")
+    assert tensor_based_rpq("a b*", graph, {0}, set()) == {(0, 1)}
+
+
+def _glushkov_fa(regex: str) -> AdjacencyMatrixFA:
+    glushkov = regex_to_glushkov(regex)
+    return AdjacencyMatrixFA.from_matrices(
+        list(range(glushkov.states_number)),
+        {0},
+        glushkov.final_states,
+        glushkov.matrices,
+    )
+
+
+def test_determinize_if_smaller_avoids_blow_up():
+    # the minimal DFA of this regex has 2^5 states
+    regex = "(a|b)* a (a|b) (a|b) (a|b) (a|b)"
+    nfa = _glushkov_fa(regex)
+    assert determinize_if_smaller(nfa) is nfa
+    assert len(nfa.states) == 12
+
+
+def test_determinize_if_smaller_shrinks():
+    nfa = _glushkov_fa("(a|b)*(a|b)")
+    dfa = determinize_if_smaller(nfa)
+    assert len(dfa.states) < len(nfa.states)
+    for word in ["", "a", "ab", "bba"]:
+        assert dfa.accepts(word) == nfa.accepts(word)
+
+
+@pytest.mark.parametrize(
+    "regex, states_number",
+    [
+        ("a*", 1),
+        ("(a|b)*c", 2),
+        ("(a b d)* | (a b c)*", 9),
+        ("(a|b)* a (a|b) (a|b) (a|b) (a|b)", 32),
+    ],
+)
+def test_minimize_matrix_fa_dfa_is_minimal(regex, states_number):
+    dfa = regex_to_matrix_fa(regex)
+    minimal = minimize_matrix_fa(dfa)
+    assert len(minimal.states) == states_number
+    for length in range(6):
+        for word in itertools.product("abcd", repeat=length):
+            assert minimal.accepts(word) == dfa.accepts(word)
+
+
+def test_minimize_matrix_fa_nfa_keeps_language():
+    regex = "(a|b)* a (a|b) (a|b) (a|b) (a|b)"
+    nfa = _glushkov_fa(regex)
+    reduced = minimize_matrix_fa(nfa)
+    # positions of the same (a|b) group are merged
+    assert len(reduced.states) == 6
+    for length in range(7):
+        for word in itertools.product("ab", repeat=length):
+            assert reduced.accepts(word) == nfa.accepts(word)
+
+
+def test_minimize_matrix_fa_trims_useless_states():
+    graph = cfpq.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    graph.add_edge(9, 10, label="a")
+    automaton = graph_to_adj_matrix_fa(graph, {0}, {1})
+    reduced = minimize_matrix_fa(automaton)
+    assert len(reduced.states) < len(automaton.states)
+    for length in range(6):
+        for word in itertools.product("ab", repeat=length):
+            assert reduced.accepts(word) == automaton.accepts(word)
+
+    empty = minimize_matrix_fa(graph_to_adj_matrix_fa(graph, {10}, {0}))
+    assert len(empty.states) == 1 and not empty.final_states
+
+
+def _naive_closure(adj: AdjacencyMatrixFA) -> np.ndarray:
+    step = adj._step_matrix().toarray()
+    closure = step.copy()
+    for _ in range(len(adj.states)):
+        closure = (closure.astype(int) @ step.astype(int)) > 0
+    return closure
+
+
+@pytest.mark.parametrize("mode", CLOSURE_MODES)
+def test_transitive_closure_modes(mode):
+    graph = cfpq.labeled_two_cycles_graph(4, 3, labels=("a", "b"))
+    graph.add_edge(7, 8, label="a")
+    adj = graph_to_adj_matrix_fa(graph, set(), set())
+    closure, stats = adj.get_trans_closure_with_stats(mode)
+    assert (closure.toarray() == _naive_closure(adj)).all()
+    assert stats.mode == mode
+    assert len(stats.nnz) == stats.iterations + 1
+    assert stats.nnz == sorted(stats.nnz)
+    assert stats.nnz[-1] == closure.nnz
+
+
+def test_transitive_closure_squaring_is_logarithmic():
+    nodes_number = 64
+    graph = cfpq.labeled_cycle_graph(nodes_number, label="a")
+    adj = graph_to_adj_matrix_fa(graph, set(), set())
+    _, squaring = adj.get_trans_closure_with_stats("squaring")
+    _, semi_naive = adj.get_trans_closure_with_stats("semi_naive")
+    assert squaring.iterations <= 7
+    assert semi_naive.iterations == nodes_number - 1
+    with pytest.raises(ValueError):
+        transitive_closure(adj._step_matrix(), "unknown")
+
+
+def test_tensor_based_rpq_closure_modes():
+    graph = cfpq.labeled_two_cycles_graph(5, 4, labels=("a", "b"))
+    results = [
+        tensor_based_rpq("a* b b*", graph, set(), set(), mode) for mode in CLOSURE_MODES
+    ]
+    assert results[0] == results[1]
+    assert len(results[0]) > 0
+
+
+@pytest.mark.parametrize(
+    "regex, start_nodes, final_nodes",
+    [
+        ("a* b", {0}, {1}),
+        ("a* b", {1}, {0}),
+        ("a a a", {0}, {3}),
+        ("b b", {0}, {0}),
+        ("(a|b)*", {2}, {7}),
+        ("c", {0}, {1}),
+        ("a", set(), {4}),
+    ],
+)
+def test_is_empty_bfs_matches_closure(regex, start_nodes, final_nodes):
+    graph = cfpq.labeled_two_cycles_graph(5, 3, labels=("a", "b"))
+    automaton = graph_to_adj_matrix_fa(graph, start_nodes, final_nodes)
+    intersection = intersect_automata(regex_to_nfa_matrix_fa(regex), automaton)
+    assert intersection.is_empty() == intersection.is_empty(all_pairs=True)
+
+
+def test_is_empty_start_state_is_final():
+    nfa = NondeterministicFiniteAutomaton()
+    nfa.add_start_state(State(0))
+    nfa.add_final_state(State(0))
+    assert AdjacencyMatrixFA(nfa).is_empty() is False
+
+
+def test_intersect_automata_keeps_product_states_implicit(monkeypatch):
+    graph = cfpq.labeled_two_cycles_graph(20, 15, labels=("a", "b"))
+    expected = tensor_based_rpq("a* b", graph, {0, 3}, set())
+    query = regex_to_nfa_matrix_fa("a* b")
+    prepared = PreparedGraph(graph)
+
+    def make_state(value):
+        raise AssertionError("product states must not be built")
+
+    monkeypatch.setattr(task3, "State", make_state)
+    intersection = intersect_automata(query, prepared.automaton({0, 3}, set()))
+    assert not intersection.is_empty()
+    assert len(intersection.start_indices()) == 2 * len(query.start_states)
+    assert tensor_based_rpq(query, prepared, {0, 3}, set()) == expected
+
+
+def test_intersect_automata_matches_kron():
+    graph = cfpq.labeled_two_cycles_graph(4, 3, labels=("a", "b"))
+    query = regex_to_nfa_matrix_fa("a* b")
+    automaton = graph_to_adj_matrix_fa(graph, {0}, {5})
+    intersection = intersect_automata(query, automaton)
+    snd_len = len(automaton.states)
+    assert len(intersection.states) == len(query.states) * snd_len
+    for fst in query.states:
+        for snd in automaton.states:
+            assert intersection.index_of_state[State((fst, snd))] == (
+                query.index_of_state[fst] * snd_len + automaton.index_of_state[snd]
+            )
+    for symbol in ["a", "b"]:
+        expected = kron(
+            query.boolean_decompress[symbol], automaton.boolean_decompress[symbol]
+        )
+        assert (intersection.boolean_decompress[symbol] != expected).nnz == 0
+    assert intersection.start_states == {
+        State((start, 0)) for start in query.start_states
+    }
+
+
+@pytest.mark.parametrize(
+    "regex, start_nodes, final_nodes",
+    [("a* b", {0}, {5}), ("a a a", {0}, {3}), ("b b", {0}, {0}), ("c", {0}, {1})],
+)
+def test_lazy_kronecker_is_empty(regex, start_nodes, final_nodes):
+    graph = cfpq.labeled_two_cycles_graph(5, 3, labels=("a", "b"))
+    query = regex_to_nfa_matrix_fa(regex)
+    automaton = graph_to_adj_matrix_fa(graph, start_nodes, final_nodes)
+    lazy = LazyKroneckerFA(query, automaton)
+    assert lazy.is_empty() == lazy.materialize().is_empty()
+
+
+def test_lazy_kronecker_step_matches_product():
+    graph = cfpq.labeled_two_cycles_graph(5, 3, labels=("a", "b"))
+    query = regex_to_nfa_matrix_fa("(a|b)* a")
+    automaton = graph_to_adj_matrix_fa(graph, set(), set())
+    lazy = LazyKroneckerFA(query, automaton)
+    product = lazy.materialize()
+    rows, cols = lazy.shape
+    front = np.zeros((1, rows * cols), dtype=bool)
+    front[0, [1, cols + 2, 4]] = True
+    expected = np.zeros(rows * cols, dtype=bool)
+    for mat in product.boolean_decompress.values():
+        expected |= (front.astype(int) @ mat.toarray().astype(int))[0] > 0
+    result = lazy.step(csr_matrix(front.reshape(rows, cols)))
+    assert (result.toarray().ravel() == expected).all()
+
+    # blocks of a stacked front are stepped independently
+    blocks = [csr_matrix(front.reshape(rows, cols)), csr_matrix((rows, cols))]
+    blocks.append(csr_matrix(np.eye(rows, cols, k=1, dtype=bool)))
+    stacked = lazy.step(vstack(blocks, format="csr"))
+    assert stacked.shape == (3 * rows, cols)
+    for i, block in enumerate(blocks):
+        part = stacked[i * rows : (i + 1) * rows]
+        assert (part != lazy.step(block)).nnz == 0
+
+
+@pytest.mark.parametrize("regex", ["a* b b*", "(a|b)*", "b a", "c"])
+@pytest.mark.parametrize(
+    "start_nodes, final_nodes", [({0, 5, 17}, set()), (set(), set()), (set(), {3})]
+)
+def test_tensor_based_rpq_lazy(regex, start_nodes, final_nodes):
+    graph = cfpq.labeled_two_cycles_graph(20, 15, labels=("a", "b"))
+    expected = tensor_based_rpq(regex, graph, start_nodes, final_nodes)
+    assert tensor_based_rpq(regex, graph, start_nodes, final_nodes, lazy=True) == (
+        expected
+    )
+
+
+def test_closure_rows_match_full_closure():
+    graph = cfpq.labeled_two_cycles_graph(6, 4, labels=("a", "b"))
+    graph.add_edge(7, 12, label="a")
+    adj = graph_to_adj_matrix_fa(graph, set(), set())
+    rows = np.array([0, 3, 11, 7])
+    expected = adj.get_trans_closure().toarray()[rows]
+    assert (closure_rows(adj._step_matrix(), rows).toarray() == expected).all()
+
+
+@pytest.mark.parametrize("regex", ["a* b b*", "(a|b)*", "b a", "c"])
+@pytest.mark.parametrize(
+    "start_nodes, final_nodes", [({0, 5, 17}, set()), (set(), set()), (set(), {3})]
+)
+def test_tensor_based_rpq_from_starts(regex, start_nodes, final_nodes):
+    graph = cfpq.labeled_two_cycles_graph(20, 15, labels=("a", "b"))
+    expected = tensor_based_rpq(regex, graph, start_nodes, final_nodes)
+    result = tensor_based_rpq(regex, graph, start_nodes, final_nodes, from_starts=True)
+    assert result == expected
@@ -0,0 +1,266 @@
+from networkx import MultiDiGraph
+from project.reachability import ReachabilityResult
+from project.task1 import graph_matrices_from_csv
+from project.matrix_backend import to_csr
+from project.task3 import (
+    PreparedGraph,
+    build_front,
+    regex_to_nfa_matrix_fa,
+    tensor_based_rpq,
+)
+from project.task4 import batch_rpq, ms_bfs_based_rpq, ms_bfs_rpq_by_source
+from project import task4
+
+from scipy.sparse import csr_matrix
+
+import cfpq_data as cfpq
+import numpy as np
+import pytest
+
+
+def test_build_front_blocks():
+    sources = np.array([4, 0, 2])
+    starts = np.array([1, 3])
+    front = build_front(5, 4, sources[:, None], starts[None, :])
+    assert front.shape == (15, 4) and front.nnz == 6
+    expected = {(b * 5 + src, st) for b, src in enumerate(sources) for st in starts}
+    assert set(zip(*front.nonzero())) == expected
+
+    transposed = build_front(4, 5, starts[None, :], sources[:, None])
+    assert set(zip(*transposed.nonzero())) == {
+        (b * 4 + st, src) for b, src in enumerate(sources) for st in starts
+    }
+    with pytest.raises(ValueError):
+        build_front(5, 4, sources, starts[:1])
+
+
+def test_build_front_large_is_sparse():
+    sources = np.arange(0, 100_000, 10)
+    front = build_front(100_000, 3, sources[:, None], np.array([[0, 2]]))
+    assert front.shape == (10**9, 3)
+    assert front.nnz == 2 * len(sources)
+
+
+@pytest.mark.parametrize("regex", ["a* b b*", "(a|b)*", "b a"])
+def test_ms_bfs_many_starts(regex):
+    graph = cfpq.labeled_two_cycles_graph(60, 45, labels=("a", "b"))
+    start_nodes = set(range(0, 106, 3))
+    expected = tensor_based_rpq(regex, graph, start_nodes, set())
+    assert ms_bfs_based_rpq(regex, graph, start_nodes, set()) == expected
+
+
+@pytest.mark.parametrize("options", [{}, {"bit_front": True}])
+def test_ms_bfs_by_source_streams_results(options):
+    # a tail of 30 "a" edges hangs off node 7 of the "b" cycle, so the
+    # search from 7 is the last to finish
+    graph = cfpq.labeled_two_cycles_graph(5, 4, labels=("a", "b"))
+    for node in range(10, 40):
+        graph.add_edge(node, node + 1, label="a")
+    graph.add_edge(7, 10, label="a")
+    start_nodes = {0, 3, 7, 37}
+    regex = "a* b"
+    expected = ms_bfs_based_rpq(regex, graph, start_nodes, set())
+
+    streamed = list(ms_bfs_rpq_by_source(regex, graph, start_nodes, set(), **options))
+    assert sorted(start for start, _ in streamed) == sorted(start_nodes)
+    assert streamed[-1][0] == 7
+    pairs = {(start, node) for start, reached in streamed for node in reached}
+    assert pairs == expected
+
+    final_nodes = {1, 6, 8}
+    answers = dict(ms_bfs_rpq_by_source(regex, graph, start_nodes, final_nodes))
+    assert answers[37] == set()
+    assert {(s, n) for s, ns in answers.items() for n in ns} == ms_bfs_based_rpq(
+        regex, graph, start_nodes, final_nodes
+    )
+
+
+def test_prepared_graph_shares_matrices():
+    graph = cfpq.labeled_two_cycles_graph(20, 15, labels=("a", "b"))
+    prepared = PreparedGraph(graph)
+    adj = prepared.automaton({0, 3}, {5})
+    for label, mat in adj.boolean_decompress.items():
+        assert mat is prepared.graph_fa.boolean_decompress[label]
+    for regex in ["a* b", "(a|b)*"]:
+        for start_nodes, final_nodes in [
+            ({0, 3}, {5, 30}),
+            (set(), set()),
+            ({99}, set()),
+        ]:
+            expected = tensor_based_rpq(regex, graph, start_nodes, final_nodes)
+            assert tensor_based_rpq(regex, prepared, start_nodes, final_nodes) == (
+                expected
+            )
+            assert ms_bfs_based_rpq(regex, prepared, start_nodes, final_nodes) == (
+                expected
+            )
+
+
+@pytest.mark.parametrize("options", [{}, {"fuse": False}, {"bit_front": True}])
+def test_batch_rpq_matches_single_queries(options):
+    graph = cfpq.labeled_two_cycles_graph(20, 15, labels=("a", "b"))
+    queries = [
+        ("a* b", {0, 3}, set()),
+        ("(a|b)*", {7}, {1, 2, 30}),
+        ("b b b", set(), set()),
+        ("c", {0}, set()),
+        ("a a", {0, 99}, {2, 100}),
+        ("a* b", {0, 3}, set()),
+    ]
+    answers = batch_rpq(PreparedGraph(graph), queries, **options)
+    assert len(answers) == len(queries)
+    for (regex, start_nodes, final_nodes), result in zip(queries, answers):
+        assert result == ms_bfs_based_rpq(regex, graph, start_nodes, final_nodes)
+    assert batch_rpq(graph, [], **options) == []
+    (result,) = batch_rpq(graph, queries[:1], as_matrix=True, **options)
+    assert isinstance(result, ReachabilityResult)
+    assert result == answers[0]
+
+
+@pytest.mark.parametrize("options", [{}, {"fuse": False}])
+def test_batch_rpq_on_csv_graph_matrices(tmp_path, options):
+    graph = cfpq.labeled_two_cycles_graph(20, 15, labels=("a", "b"))
+    csv_path = tmp_path / "g.csv"
+    cfpq.graph_to_csv(graph, csv_path)
+    expected_graph = cfpq.graph_from_csv(csv_path)
+    matrices = graph_matrices_from_csv(csv_path)
+    queries = [
+        ("a* b", {0, 3}, set()),
+        ("(a|b)*", {7}, {1, 2, 30}),
+        ("a a", {0, 99}, {2, 100}),
+    ]
+    expected = [
+        ms_bfs_based_rpq(regex, expected_graph, start_nodes, final_nodes)
+        for regex, start_nodes, final_nodes in queries
+    ]
+    assert batch_rpq(matrices, queries, **options) == expected
+    assert batch_rpq(PreparedGraph(matrices), queries, **options) == expected
+    regex, start_nodes, final_nodes = queries[0]
+    assert tensor_based_rpq(regex, matrices, start_nodes, final_nodes) == expected[0]
+
+
+def test_batch_rpq_builds_query_steps_once(monkeypatch):
+    graph = cfpq.labeled_two_cycles_graph(20, 15, labels=("a", "b"))
+    queries = [("a a", {0}, set()), ("a* b", {0, 3}, set()), ("(a|b)*", {7}, set())]
+    kron_calls = []
+    kron = task4.kron
+
+    def counting_kron(*args, **kwargs):
+        kron_calls.append(args)
+        return kron(*args, **kwargs)
+
+    expected = batch_rpq(graph, queries)
+    monkeypatch.setattr(task4, "kron", counting_kron)
+    assert batch_rpq(graph, queries) == expected
+    # one part per query and label; retired blocks do not rebuild them
+    assert len(kron_calls) == len(queries) * 2
+
+
+def _product_successors(query, graph_fa, q, v):
+    for label in query.labels & graph_fa.labels:
+        q_row = query.boolean_decompress[label].getrow(q)
+        v_row = graph_fa.boolean_decompress[label].getrow(v)
+        for q_next in q_row.indices[q_row.data]:
+            for v_next in v_row.indices[v_row.data]:
+                yield int(q_next), int(v_next)
+
+
+def test_ms_bfs_step_matches_per_block_products():
+    graph = cfpq.labeled_two_cycles_graph(6, 4, labels=("a", "b"))
+    graph_fa = PreparedGraph(graph).graph_fa
+    queries = [
+        regex_to_nfa_matrix_fa("(a|b)* a a", determinize=False),
+        regex_to_nfa_matrix_fa("a b* | a a", determinize=False),
+    ]
+    # a non-deterministic query moves a state to several states at once
+    assert any(
+        (mat.getnnz(axis=1) > 1).any() for mat in queries[0].boolean_decompress.values()
+    )
+    starts = [np.array([0, 3, 7]), np.array([2, 5])]
+    query_of_block, start_of_block, block_len = task4._blocks_layout(queries, starts)
+    steps = task4._query_steps(queries, query_of_block, {"a", "b"}, None)
+
+    # every block holds a few arbitrary cells
+    rng = np.random.default_rng(0)
+    front = csr_matrix(rng.random((block_len.sum(), len(graph_fa.states))) < 0.3)
+    offsets = np.concatenate([[0], np.cumsum(block_len)])
+    for label in ["a", "b"]:
+        graph_mat = graph_fa.boolean_decompress[label]
+        result = (steps[label] @ front @ graph_mat).toarray()
+        for block, query_number in enumerate(query_of_block):
+            rows = slice(offsets[block], offsets[block + 1])
+            query_mat = queries[query_number].boolean_decompress[label]
+            expected = (query_mat.T @ front[rows] @ graph_mat).toarray()
+            assert (result[rows] == expected).all()
+
+
+@pytest.mark.parametrize("bit_front", [False, True])
+def test_ms_bfs_expands_every_product_state_once(monkeypatch, bit_front):
+    graph = cfpq.labeled_two_cycles_graph(6, 4, labels=("a", "b"))
+    graph_fa = PreparedGraph(graph).graph_fa
+    query = regex_to_nfa_matrix_fa("(a|b)* a", determinize=False)
+    query_len, graph_len = len(query.states), len(graph_fa.states)
+    start = int(graph_fa.index_of_state[0])
+
+    fronts = []
+    matmul = task4.matmul
+
+    def recording_matmul(fst, snd):
+        # P @ front, with P square over the query states
+        if fst.shape == (query_len, query_len) and snd.shape[1] == graph_len:
+            if not any(snd is front for front in fronts):
+                fronts.append(snd)
+        return matmul(fst, snd)
+
+    monkeypatch.setattr(task4, "matmul", recording_matmul)
+    searches = task4._ms_bfs(
+        graph_fa, [query], [np.array([start])], bit_front, None, None
+    )
+    ((blocks, visited),) = list(searches)
+    assert blocks.tolist() == [0]
+
+    expanded = []
+    for front in fronts:
+        rows, cols = to_csr(front).nonzero()
+        expanded.extend(zip(rows.tolist(), cols.tolist()))
+    # the graph has cycles, but no product state is expanded twice
+    assert len(expanded) == len(set(expanded))
+
+    reachable = {(int(q), start) for q in query.start_indices()}
+    queue = list(reachable)
+    while queue:
+        for state in _product_successors(query, graph_fa, *queue.pop()):
+            if state not in reachable:
+                reachable.add(state)
+                queue.append(state)
+    assert set(expanded) == reachable
+    rows, cols = to_csr(visited).nonzero()
+    assert set(zip(rows.tolist(), cols.tolist())) == reachable
+
+
+@pytest.mark.parametrize("options", [{}, {"bit_front": True}])
+def test_ms_bfs_dense_query_matrices(options):
+    # the transposed query matrices are half full, so a sparse kron of
+    # them stores False entries that must not become transitions
+    graph = MultiDiGraph()
+    graph.add_edge(4, 2, label="a")
+    graph.add_edge(4, 2, label="b")
+    regex = "(a a | a b)*"
+    expected = tensor_based_rpq(regex, graph, {4}, {2, 4})
+    assert expected == {(4, 4)}
+    assert ms_bfs_based_rpq(regex, graph, {4}, {2, 4}, **options) == expected
+    queries = [(regex, {4}, {2, 4}), ("a", {4}, set()), (regex, {2, 4}, set())]
+    answers = batch_rpq(graph, queries, **options)
+    for (query, start_nodes, final_nodes), result in zip(queries, answers):
+        assert result == tensor_based_rpq(query, graph, start_nodes, final_nodes)
+
+
+def test_ms_bfs_by_source_with_string_nodes():
+    graph = MultiDiGraph()
+    graph.add_edge("x", "y", label="a")
+    graph.add_edge("y", "z", label="b")
+    graph.add_edge(("t", 1), "x", label="a")
+    answers = dict(ms_bfs_rpq_by_source("a* b", graph, {"x", ("t", 1)}, set()))
+    assert answers == {"x": {"z"}, ("t", 1): {"z"}}
+    for start, _ in ms_bfs_rpq_by_source("a", graph, {"x", "y"}, set()):
+        assert type(start) is str